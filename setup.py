@@ -10,8 +10,7 @@ setup(name = "trimage",
     author_email = "help@trimage.org",
     url = "http://trimage.org",
     license = "MIT license",
-    packages = ["trimage",
-              "trimage.ThreadPool"],
+    packages = ["trimage"],
     package_data = {"trimage" : ["pixmaps/*.*"] },
     data_files=[('share/icons/hicolor/scalable/apps', ['desktop/trimage.svg']),
             ('share/applications', ['desktop/trimage.desktop']),
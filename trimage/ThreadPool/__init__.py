@@ -1 +0,0 @@
-from .ThreadPool import ThreadPool, ThreadPoolMixIn
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+The optimizers trimage can run, one backend per file type.
+
+A backend declares the extensions and media type of its files, how to
+recognise them, the pipelines that optimize them (see pipeline.py), how much
+memory its tools need and whether they leave the image exactly as it was.
+Its output is validated before it replaces the original. Backends whose
+tools are not installed are left out, so an image is only taken on when
+something can optimize it.
+"""
+
+from os import path
+from functools import lru_cache
+from collections import namedtuple
+from xml.etree import ElementTree
+
+from pipeline import BUILTINS, STRATEGIES, SIGNATURES, jpeg_pipeline
+from strip import JPEG_KEEP
+from tools import find_tools, supported_level
+
+
+# filetype      name shared by every image of this type
+# extensions    lower case, without the dot
+# media_type    its MIME type
+# sniff         function telling from the first HEAD bytes if data is this
+#               type
+# strategies    dict of strategy name to pipeline; the first one is the
+#               default, the others are raced against it in race mode
+# memory        memory the tools need, as a multiple of the raw pixel data
+# lossless      True if the decoded image never changes
+# validate      function telling if a file the tools left behind is usable
+Backend = namedtuple("Backend", "filetype extensions media_type sniff "
+    "strategies memory lossless validate")
+
+HEAD = 64
+
+# how the apps whose levels are probed take them, e.g. "-o7"
+LEVEL_FLAGS = {
+    "optipng": "-o",
+    "advpng": "-z",
+}
+
+# every registered backend, by filetype
+BACKENDS = {}
+
+# extension to filetype, so every image shares the same strings
+FILETYPES = {}
+
+
+def register(backend):
+    """Add backend, replacing any earlier one for its filetype."""
+    BACKENDS[backend.filetype] = backend
+    for extension in backend.extensions:
+        FILETYPES[extension] = backend.filetype
+    available.cache_clear()
+
+
+def filetype_of(fullpath):
+    """Return the filetype of fullpath going by its extension, or None."""
+    return FILETYPES.get(path.splitext(fullpath)[1][1:].lower())
+
+
+def sniff(head):
+    """Return the filetype the first bytes of a file belong to, or None."""
+    return next((backend.filetype for backend in BACKENDS.values()
+        if backend.sniff(head)), None)
+
+
+def installed_levels(steps):
+    """
+    Return steps with every optimization level lowered to the highest one
+    the installed app supports.
+    """
+    def clamp(argv):
+        flag = LEVEL_FLAGS.get(argv[0])
+        if flag is None:
+            return argv
+        return [flag + str(supported_level(argv[0], int(arg[len(flag):])))
+            if arg.startswith(flag) and arg[len(flag):].isdigit() else arg
+            for arg in argv]
+    return [clamp(argv) for argv in steps]
+
+
+def strategies(backend):
+    """Return the strategies of backend, at levels the installed apps have."""
+    return {name: installed_levels(steps)
+        for name, steps in backend.strategies.items()}
+
+
+def default_pipeline(backend):
+    """Return the default pipeline of backend, see strategies."""
+    return installed_levels(next(iter(backend.strategies.values())))
+
+
+def required_tools(backend):
+    """Return the external apps the pipelines of backend run."""
+    return {argv[0] for pipeline in backend.strategies.values()
+        for argv in pipeline if argv[0] not in BUILTINS}
+
+
+@lru_cache(maxsize=None)
+def available(filetype):
+    """Return True if filetype has a backend whose tools are installed."""
+    backend = BACKENDS.get(filetype)
+    if backend is None:
+        return False
+    installed = find_tools()
+    return all(installed.get(tool) for tool in required_tools(backend))
+
+
+def read_head(fullpath):
+    with open(fullpath, "rb") as f:
+        return f.read(HEAD)
+
+
+def signature(*prefixes):
+    """Return a sniff function matching any of prefixes."""
+    return lambda head: head.startswith(prefixes)
+
+
+def sniff_webp(head):
+    return head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+
+
+def sniff_svg(head):
+    head = head.lstrip(b"\xef\xbb\xbf \t\r\n")
+    return head.startswith(b"<svg") or (head.startswith((b"<?xml", b"<!--"))
+        and b"<svg" in head)
+
+
+def valid_signature(sniff):
+    """Return a validate function checking the signature of the output."""
+    def validate(fullpath):
+        return sniff(read_head(fullpath))
+    return validate
+
+
+def valid_svg(fullpath):
+    """Check that the output still parses and is an SVG document."""
+    try:
+        root = ElementTree.parse(fullpath).getroot()
+    except (ElementTree.ParseError, OSError):
+        return False
+    return root.tag == "svg" or root.tag.endswith("}svg")
+
+
+def signature_backend(filetype, extensions, media_type, sniff, strategies,
+        memory, lossless=True):
+    """Return a Backend whose output only needs the right signature."""
+    return Backend(filetype, extensions, media_type, sniff, strategies,
+        memory, lossless, valid_signature(sniff))
+
+
+def jpeg_backend(keep=()):
+    """Return the JPEG backend, keeping the metadata named in keep."""
+    return signature_backend("jpeg", ("jpg", "jpeg"), "image/jpeg",
+        signature(SIGNATURES["jpeg"]), {"jpegoptim": jpeg_pipeline(keep)},
+        2.0)
+
+
+def keep_policy(value):
+    """
+    Return the metadata names in value, a comma separated list such as
+    "orientation,icc"; raise ValueError for names JPEG_KEEP does not have.
+    """
+    keep = {name.strip().lower() for name in value.split(",") if name.strip()}
+    unknown = keep - JPEG_KEEP
+    if unknown:
+        raise ValueError("unknown metadata {}, expected some of {}".format(
+            ", ".join(sorted(unknown)), ", ".join(sorted(JPEG_KEEP))))
+    return frozenset(keep)
+
+
+register(signature_backend("png", ("png",), "image/png",
+    signature(SIGNATURES["png"]), STRATEGIES["png"], 3.0))
+
+register(jpeg_backend())
+
+# -z 9 is lossless at its slowest, -exact keeps the colour of transparent
+# pixels; lossy WebP files come out bigger and are left alone
+register(signature_backend("webp", ("webp",), "image/webp", sniff_webp, {
+    "cwebp": [
+        ["cwebp", "-quiet", "-z", "9", "-exact", "-metadata", "icc",
+            "{file}", "-o", "{output}"],
+    ],
+}, 8.0))
+
+register(signature_backend("gif", ("gif",), "image/gif",
+    signature(b"GIF87a", b"GIF89a"), {
+    "gifsicle": [
+        ["gifsicle", "--no-warnings", "-O3", "{file}", "-o", "{output}"],
+    ],
+}, 2.0))
+
+# svgo rounds coordinates, so SVG files are only taken on when asked for
+register(Backend("svg", ("svg",), "image/svg+xml", sniff_svg, {
+    "svgo": [
+        ["svgo", "--quiet", "--multipass", "{file}", "--output", "{output}"],
+    ],
+}, 4.0, False, valid_svg))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import os
+from os import path
+from time import monotonic
+from fnmatch import fnmatch
+from queue import Queue, Full
+
+from executor import BoundedExecutor
+from image import Status
+from tools import human_readable_size
+
+
+IGNORED_NAMES = [".", "..", ".svn", ".git", ".hg", ".bzr", ".cvs"]
+
+
+def scan(paths, include=None, exclude=None, max_depth=None, onerror=None):
+    """
+    Lazily yield every file in paths, descending into directories.
+
+    Files are yielded as soon as they are found, so compression can start
+    before a big tree has been read. Directories are read with os.scandir,
+    version control directories are skipped and every directory is entered
+    at most once, which stops symlink loops.
+
+    @param include Glob patterns; if given, only matching files are yielded.
+    @param exclude Glob patterns of files and directories to skip.
+    @param max_depth How many directory levels below each path to descend.
+    @param onerror Called with the OSError of a directory that can't be read.
+    Patterns match the name or the path relative to the scanned directory.
+    Files named explicitly in paths are always yielded.
+    """
+    for fullpath in paths:
+        fullpath = path.abspath(fullpath)
+        if path.isdir(fullpath):
+            yield from scan_dir(fullpath, include, exclude, max_depth, onerror)
+        else:
+            yield fullpath
+
+
+def scan_dir(root, include=None, exclude=None, max_depth=None, onerror=None):
+    """Yield the files below root, see scan."""
+    visited = set()
+    stack = [(root, 0)]
+    while stack:
+        dir, depth = stack.pop()
+        subdirs = []
+        try:
+            st = os.stat(dir)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    if entry.name in IGNORED_NAMES:
+                        continue
+                    relpath = path.relpath(entry.path, root)
+                    if exclude and matches(entry.name, relpath, exclude):
+                        continue
+                    try:
+                        isdir = entry.is_dir()
+                    except OSError:
+                        continue
+                    if isdir:
+                        if max_depth is None or depth < max_depth:
+                            subdirs.append(entry.path)
+                    elif not include or matches(entry.name, relpath, include):
+                        yield entry.path
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+        stack.extend((subdir, depth + 1) for subdir in reversed(subdirs))
+
+
+def matches(name, relpath, patterns):
+    """Return True if name or relpath matches one of the glob patterns."""
+    return any(fnmatch(name, pattern) or fnmatch(relpath, pattern)
+        for pattern in patterns)
+
+
+def add_common_options(parser):
+    """Add the options every command that compresses images takes."""
+    add_cache_option(parser)
+    parser.add_option("--lossy", action="store_true", dest="lossy",
+        default=False, help="also optimize SVG files, with svgo, which may "
+            "round coordinates")
+    parser.add_option("--keep-metadata", action="store", type="string",
+        dest="keep_metadata", default="", metavar="NAMES", help="keep the "
+            "JPEG metadata in NAMES, a comma separated list of orientation "
+            "and icc (default: remove all of it)")
+
+
+def add_cache_option(parser, prefix=""):
+    """Add --no-cache, its help starting with prefix."""
+    parser.add_option("--no-cache", action="store_false", dest="cache",
+        default=True, help=prefix + "compress every image, even ones an "
+            "earlier run already optimized")
+
+
+def compress_images(images, workers=None, scheduler=None):
+    """
+    Compress images concurrently and yield each one as soon as it is done.
+
+    No Qt objects are involved, so this can be used on machines without a
+    display. Only a bounded number of images is handed to the pool at a time,
+    so images may be a lazily produced iterable.
+
+    @param scheduler An optional Scheduler each image has to wait for.
+    """
+    done = Queue()
+    pending = 0
+    with BoundedExecutor(workers) as executor:
+        for image in images:
+            while True:
+                try:
+                    executor.submit(compress_image, image, scheduler,
+                        block=False,
+                        callback=lambda future: done.put(future.result()))
+                    pending += 1
+                    break
+                except Full:
+                    # hand back finished images while waiting for a slot
+                    yield done.get()
+                    pending -= 1
+        for _ in range(pending):
+            yield done.get()
+
+
+def compress_image(image, scheduler=None):
+    """Compress one image, marking it as failed instead of raising."""
+    try:
+        if scheduler is None:
+            return image.compress()
+        with scheduler.reserve(image):
+            return image.compress()
+    except Exception:
+        image.status = Status.FAILED
+        image.retcode = -1
+        return image
+
+
+def format_result(image):
+    """Return the one-line summary printed for a compressed image."""
+    ratio = 100 - (float(image.newfilesize) / image.oldfilesize * 100)
+    result = ("File: " + image.fullpath
+        + ", Old Size: " + human_readable_size(image.oldfilesize)
+        + ", New Size: " + human_readable_size(image.newfilesize)
+        + ", Ratio: " + "%.1f%%" % ratio)
+    if image.race:
+        result += ", Strategy: " + (image.strategy or "none")
+    if image.converge is not None:
+        result += ", Passes: {}{}".format(image.passes,
+            " (converged)" if image.converged else "")
+    if image.verified is not None:
+        result += ", Verified in %.3fs" % verify_seconds(image)[0]
+    return result
+
+
+def verify_seconds(image):
+    """Return the wall and CPU seconds spent verifying image."""
+    checks = [step for step in image.steps if step.tool == "verify"]
+    return (sum(step.wall for step in checks),
+        sum(step.cpu for step in checks))
+
+
+def result_record(image):
+    """Return the machine readable record of a compressed image."""
+    return {
+        "type": "file",
+        "path": image.fullpath,
+        "filetype": image.filetype,
+        "retcode": image.retcode,
+        "old_size": image.oldfilesize,
+        "new_size": image.newfilesize if image.compressed else None,
+        "cached": image.cached,
+        "strategy": image.strategy,
+        "level": image.level,
+        "passes": image.passes,
+        "converged": image.converged,
+        "verified": image.verified,
+        "wall": round(image.seconds, 6),
+        "steps": [{
+            "tool": step.tool,
+            "retcode": step.retcode,
+            "wall": round(step.wall, 6),
+            "cpu": None if step.cpu is None else round(step.cpu, 6),
+            "strategy": step.strategy,
+        } for step in image.steps],
+    }
+
+
+class Totals:
+    """Running totals over a batch, for the closing summary."""
+
+    def __init__(self):
+        self.start = monotonic()
+        self.files = 0
+        self.failed = 0
+        self.cached = 0
+        self.converged = 0
+        self.verify_wall = 0.0
+        self.verify_cpu = 0.0
+        self.old_bytes = 0
+        self.new_bytes = 0
+
+    def add(self, image):
+        self.files += 1
+        wall, cpu = verify_seconds(image)
+        self.verify_wall += wall
+        self.verify_cpu += cpu
+        if not image.compressed:
+            self.failed += 1
+            return
+        self.cached += image.cached
+        self.converged += image.converged
+        self.old_bytes += image.oldfilesize
+        self.new_bytes += image.newfilesize
+
+    def record(self):
+        """Return the summary record of the batch so far."""
+        seconds = monotonic() - self.start
+        rate = 1 / seconds if seconds > 0 else 0.0
+        return {
+            "type": "summary",
+            "files": self.files,
+            "failed": self.failed,
+            "cached": self.cached,
+            "converged": self.converged,
+            "old_bytes": self.old_bytes,
+            "new_bytes": self.new_bytes,
+            "saved_bytes": self.old_bytes - self.new_bytes,
+            "seconds": round(seconds, 6),
+            "verify_seconds": round(self.verify_wall, 6),
+            "verify_cpu_seconds": round(self.verify_cpu, 6),
+            "files_per_second": round(self.files * rate, 3),
+            "mb_per_second": round(self.old_bytes / 1e6 * rate, 3),
+        }
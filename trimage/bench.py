@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+`trimage bench`: measure throughput on a synthetic corpus.
+"""
+
+import sys
+import json
+import shutil
+import platform
+import resource
+import tempfile
+from os import path, makedirs
+from time import monotonic
+from optparse import OptionParser
+
+from batch import compress_images, Totals
+from corpus import write_corpus
+from image import Image
+from scheduler import cpu_limit
+from tools import VERSION, check_dependencies, dependency_versions
+
+
+def build_parser():
+    parser = OptionParser(usage="%prog bench [options]",
+        version="%prog " + VERSION,
+        description="Compress a generated corpus of PNG and JPEG files at "
+            "several worker counts and report the throughput.")
+    parser.add_option("-w", "--workers", action="store", type="string",
+        dest="workers", default="1,{}".format(cpu_limit()),
+        help="comma separated worker counts to run (default: 1 and the "
+            "number of CPUs this process may use)")
+    parser.add_option("-n", "--copies", action="store", type="int",
+        dest="copies", default=1, help="how many copies of the corpus to "
+            "compress per run")
+    parser.add_option("--seed", action="store", type="int", dest="seed",
+        default=0, help="seed of the generated corpus")
+    parser.add_option("-o", "--output", action="store", type="string",
+        dest="output", metavar="FILE", help="write the results as JSON to "
+            "FILE instead of standard output")
+    return parser
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_rss_kb(who):
+    """Return the peak resident set size so far, in kilobytes."""
+    peak = resource.getrusage(who).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak // 1024 if platform.system() == "Darwin" else peak
+
+
+def run(corpus, workdir, workers):
+    """Compress a fresh copy of the corpus with workers threads."""
+    makedirs(workdir)
+    copies = []
+    for fullpath in corpus:
+        copies.append(path.join(workdir, path.basename(fullpath)))
+        shutil.copyfile(fullpath, copies[-1])
+
+    latencies = []
+    totals = Totals()
+    start = monotonic()
+    for image in compress_images((Image(p) for p in copies), workers):
+        latencies.append(image.seconds)
+        totals.add(image)
+    seconds = monotonic() - start
+
+    return {
+        "workers": workers,
+        "files": totals.files,
+        "failed": totals.failed,
+        "seconds": round(seconds, 3),
+        "files_per_second": round(totals.files / seconds, 3),
+        "old_bytes": totals.old_bytes,
+        "new_bytes": totals.new_bytes,
+        "saved_bytes": totals.old_bytes - totals.new_bytes,
+        "p50_seconds": round(percentile(latencies, 0.5), 4),
+        "p95_seconds": round(percentile(latencies, 0.95), 4),
+        # both are maxima since the start of the benchmark, not per run
+        "peak_rss_kb": peak_rss_kb(resource.RUSAGE_SELF),
+        "peak_child_rss_kb": peak_rss_kb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def main(argv=None):
+    """Run the benchmark and report the results."""
+    parser = build_parser()
+    options, args = parser.parse_args(argv)
+    try:
+        workers = sorted({int(w) for w in options.workers.split(",")})
+    except ValueError:
+        parser.error("--workers needs a comma separated list of numbers")
+    if not workers or workers[0] < 1:
+        parser.error("--workers needs numbers of at least 1")
+
+    if not check_dependencies():
+        return 1
+
+    tempdir = tempfile.mkdtemp(prefix="trimage-bench-")
+    try:
+        corpusdir = path.join(tempdir, "corpus")
+        makedirs(corpusdir)
+        corpus = write_corpus(corpusdir, options.copies, options.seed)
+        results = {
+            "trimage": VERSION,
+            "python": platform.python_version(),
+            "cpus": cpu_limit(),
+            "tools": dependency_versions(),
+            "corpus": {
+                "seed": options.seed,
+                "copies": options.copies,
+                "files": len(corpus),
+                "bytes": sum(path.getsize(p) for p in corpus),
+            },
+            "runs": [],
+        }
+        for count in workers:
+            result = run(corpus, path.join(tempdir, "run-%d" % count), count)
+            results["runs"].append(result)
+            print("workers: {workers}, files/s: {files_per_second}, "
+                "saved: {saved_bytes} B, p50: {p50_seconds}s, "
+                "p95: {p95_seconds}s, peak RSS: {peak_rss_kb} KB".format(
+                    **result), file=sys.stderr)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import sqlite3
+import hashlib
+from os import path
+from threading import Lock
+
+
+def default_cache_path(name="results.sqlite"):
+    """Return the location of a cache file for the current user."""
+    base = os.environ.get("XDG_CACHE_HOME") or path.expanduser("~/.cache")
+    return path.join(base, "trimage", name)
+
+
+def file_digest(fullpath, blocksize=1 << 20):
+    """Hash the contents of a file."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(fullpath, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent record of compression results, keyed by content hash.
+
+    Every entry belongs to a recipe (the commands used for a filetype) and
+    stores the hash of the output those commands produced. An entry whose
+    output hash equals its own hash is already optimal: running the recipe
+    again would not gain anything. Separately, contents on which convergence
+    mode found repeated runs to stop paying off are recorded as converged,
+    so they are never worked on again. The whole cache is dropped when the
+    installed tool versions differ from the ones it was filled with, and the
+    least recently used entries are evicted once it holds more than
+    max_entries results.
+    """
+
+    def __init__(self, filename=None, tools="", max_entries=200000):
+        self.filename = filename or default_cache_path()
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.writes = 0
+
+        if self.filename != ":memory:":
+            os.makedirs(path.dirname(self.filename), exist_ok=True)
+        self.db = sqlite3.connect(self.filename, timeout=30,
+            check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta "
+                "(key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                "(hash TEXT, recipe TEXT, output TEXT, used REAL, "
+                "PRIMARY KEY (hash, recipe))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS results_used "
+                "ON results (used)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS converged "
+                "(hash TEXT, recipe TEXT, passes INTEGER, used REAL, "
+                "PRIMARY KEY (hash, recipe))")
+            row = self.db.execute("SELECT value FROM meta "
+                "WHERE key = 'tools'").fetchone()
+            if row is None or row[0] != tools:
+                # the tools changed, so earlier results may no longer hold
+                self.db.execute("DELETE FROM results")
+                self.db.execute("DELETE FROM converged")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES "
+                    "('tools', ?)", (tools,))
+
+    @staticmethod
+    def recipe_key(recipe):
+        """Shorten a recipe (a command template) to a stable key."""
+        return hashlib.blake2b(recipe.encode("utf-8"),
+            digest_size=8).hexdigest()
+
+    def lookup(self, digest, recipe):
+        """Return the output hash recorded for digest, or None."""
+        key = self.recipe_key(recipe)
+        with self.lock, self.db:
+            row = self.db.execute("SELECT output FROM results "
+                "WHERE hash = ? AND recipe = ?", (digest, key)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE results SET used = ? "
+                "WHERE hash = ? AND recipe = ?", (time.time(), digest, key))
+        return row[0]
+
+    def is_optimal(self, digest, recipe):
+        """Return True if running recipe on this content gains nothing."""
+        return self.lookup(digest, recipe) == digest
+
+    def store(self, digest, recipe, output):
+        """
+        Record that recipe turned content digest into content output.
+
+        The output itself is recorded as optimal: running the same recipe on
+        it again is not expected to gain anything.
+        """
+        key = self.recipe_key(recipe)
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO results "
+                "VALUES (?, ?, ?, ?)",
+                [(digest, key, output, now), (output, key, output, now)])
+            self.writes += 1
+            if self.writes % 1000 == 0:
+                self._evict()
+
+    def is_converged(self, digest, recipe):
+        """Return True if this content was recorded as converged."""
+        key = self.recipe_key(recipe)
+        with self.lock, self.db:
+            return self.db.execute("UPDATE converged SET used = ? "
+                "WHERE hash = ? AND recipe = ?",
+                (time.time(), digest, key)).rowcount == 1
+
+    def mark_converged(self, digest, recipe, passes):
+        """
+        Record that running recipe on this content again stopped paying off,
+        after passes runs.
+        """
+        key = self.recipe_key(recipe)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO converged "
+                "VALUES (?, ?, ?, ?)", (digest, key, passes, time.time()))
+
+    def _evict(self):
+        """Remove the least recently used entries above max_entries."""
+        for table in ("results", "converged"):
+            count = self.db.execute("SELECT COUNT(*) FROM " + table) \
+                .fetchone()[0]
+            excess = count - self.max_entries
+            if excess > 0:
+                self.db.execute("DELETE FROM {0} WHERE rowid IN (SELECT "
+                    "rowid FROM {0} ORDER BY used LIMIT ?)".format(table),
+                    (excess,))
+
+    def clear(self):
+        """Forget every recorded result."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM results")
+            self.db.execute("DELETE FROM converged")
+
+    def close(self):
+        with self.lock, self.db:
+            self._evict()
+        self.db.close()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+"""
+Headless command line front-end.
+
+Nothing in here (or in the modules it imports) may import PyQt5, so that
+`trimage -f` and `trimage -d` run on machines without a display.
+"""
+
+import sys
+import json
+import importlib
+from optparse import OptionParser
+
+from batch import (scan, compress_images, format_result, result_record,
+    Totals, add_common_options)
+from backends import BACKENDS, register, jpeg_backend, keep_policy
+from image import Image, Convergence
+from journal import Journal, JournalBusy
+from pipeline import STRATEGIES
+from effort import EFFORTS, EffortModel, EffortPolicy
+from manifest import Manifest
+from scheduler import Scheduler, largest_first
+from tools import VERSION, check_dependencies, open_cache
+from verify import MODES, Verifier, decoder_available
+
+
+def build_parser():
+    """Set up the command line options shared by the GUI and the CLI."""
+    parser = OptionParser(version="%prog " + VERSION,
+        description="GUI front-end to compress png, jpg, webp, gif and svg "
+            "images via advpng, jpegoptim, optipng, pngcrush, cwebp, gifsicle "
+            "and svgo")
+
+    parser.set_defaults(verbose=True)
+    parser.add_option("-v", "--verbose", action="store_true",
+        dest="verbose", help="Verbose mode (default)")
+    parser.add_option("-q", "--quiet", action="store_false",
+        dest="verbose", help="Quiet mode")
+
+    parser.add_option("-f", "--file", action="store", type="string",
+        dest="filename", help="compresses image and exit")
+    parser.add_option("-d", "--directory", action="store", type="string",
+        dest="directory", help="compresses images in directory and exit")
+    add_common_options(parser)
+    parser.add_option("--race", action="store_true", dest="race",
+        default=False, help="run alternative optimizer strategies at once "
+            "and keep the smallest result")
+    parser.add_option("--target", action="store", type="float",
+        dest="target", metavar="PERCENT", help="with --race, stop the other "
+            "strategies once one saves at least PERCENT of the file")
+    parser.add_option("--effort", action="store", type="choice",
+        choices=EFFORTS, dest="effort", default="max", help="how hard to "
+            "try on PNG files: fast, balanced or max (default)")
+    parser.add_option("--time-budget", action="store", type="float",
+        dest="file_budget", metavar="SECONDS", help="lower the PNG levels "
+            "of images predicted to take longer than SECONDS")
+    parser.add_option("--batch-budget", action="store", type="float",
+        dest="batch_budget", metavar="SECONDS", help="lower the PNG levels "
+            "as needed to finish the whole run in about SECONDS")
+    parser.add_option("--converge", action="store_true", dest="converge",
+        default=False, help="compress each image again until a run saves "
+            "too little, and remember the ones that got there so later runs "
+            "skip them")
+    parser.add_option("--max-passes", action="store", type="int",
+        dest="max_passes", default=5, metavar="N", help="with --converge, "
+            "compress an image at most N times per run (default: %default)")
+    parser.add_option("--converge-threshold", action="store", type="float",
+        dest="converge_threshold", default=0.1, metavar="PERCENT",
+        help="with --converge, stop once a run saves at most PERCENT of the "
+            "file (default: %default)")
+    parser.add_option("--verify", action="store", type="choice",
+        choices=MODES, dest="verify", metavar="MODE", help="keep the "
+            "original unless the optimized image decodes to the same pixels, "
+            "checking all of them (full), some tiles (sampled) or a hash of "
+            "them (hash); needs Pillow")
+    parser.add_option("--verify-sample", action="store", type="float",
+        dest="verify_sample", default=10.0, metavar="PERCENT",
+        help="with --verify=sampled, compare PERCENT of the tiles of each "
+            "image (default: %default)")
+    parser.add_option("--include", action="append", dest="include",
+        metavar="PATTERN", help="only compress files matching the glob "
+            "PATTERN; may be given more than once")
+    parser.add_option("--exclude", action="append", dest="exclude",
+        metavar="PATTERN", help="skip files and directories matching the "
+            "glob PATTERN; may be given more than once")
+    parser.add_option("--max-depth", action="store", type="int",
+        dest="max_depth", metavar="N", help="descend at most N directory "
+            "levels below -d")
+    parser.add_option("--changed-only", action="store_true",
+        dest="changed_only", default=False, help="with -d, skip files whose "
+            "size and modification time are unchanged since the last run")
+    parser.add_option("--resume", action="store_true", dest="resume",
+        default=False, help="with -d, carry on where an interrupted run "
+            "over the same directory stopped: skip the files it finished and "
+            "undo what it left half done")
+    parser.add_option("--format", action="store", type="choice",
+        choices=["text", "jsonl"], dest="format", default="text",
+        help="print results as text (default) or as JSON Lines: one record "
+            "per file with raw sizes and timings, then a summary record")
+    return parser
+
+
+def is_headless(argv):
+    """Return True if the arguments ask for a run without the GUI."""
+    if argv and argv[0] in COMMANDS:
+        return True
+    options, args = build_parser().parse_args(argv)
+    return bool(options.filename or options.directory)
+
+
+def iter_images(paths, options, cache=None, effort=None, manifest=None,
+        verifier=None, journal=None):
+    """
+    Yield the valid images in paths, reporting the ones that are not.
+
+    Files the manifest knows to be unchanged, or the journal to be finished
+    already, are skipped; the others are queued in the journal.
+    """
+    target = options.target / 100 if options.target is not None else None
+    converge = None
+    if options.converge:
+        converge = Convergence(max(options.max_passes, 1),
+            options.converge_threshold / 100)
+    for fullpath in scan(paths, options.include, options.exclude,
+            options.max_depth, onerror=report_error):
+        if manifest is not None and manifest.unchanged(fullpath):
+            continue
+        if journal is not None and journal.committed(fullpath):
+            continue
+        image = Image(fullpath, cache, options.race, target, effort,
+            converge, options.lossy, verifier)
+        if image.valid:
+            if journal is not None:
+                journal.queue(fullpath)
+            yield image
+        elif image.filetype in BACKENDS and not options.lossy \
+                and not BACKENDS[image.filetype].lossless:
+            print("[error] {} skipped, its optimizer is not lossless (see "
+                "--lossy)".format(image.fullpath), file=sys.stderr)
+        else:
+            print("[error] {} not a supported image file and/or not writable"
+                .format(image.fullpath), file=sys.stderr)
+
+
+def journaled(images, journal):
+    """Yield images, recording each one as started as it is handed out."""
+    for image in images:
+        journal.start(image.fullpath)
+        yield image
+
+
+def report_error(error):
+    print("[error] {}".format(error), file=sys.stderr)
+
+
+def main(argv=None):
+    """Compress the images given on the command line and exit."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        # only the command that runs is imported, so plain runs start fast
+        return importlib.import_module(COMMANDS[argv[0]]).main(argv[1:])
+    parser = build_parser()
+    options, args = parser.parse_args(argv)
+    if options.resume and not options.directory:
+        parser.error("--resume needs -d")
+    try:
+        register(jpeg_backend(keep_policy(options.keep_metadata)))
+    except ValueError as e:
+        parser.error(str(e))
+
+    # check if dependencies are installed
+    if not check_dependencies():
+        return 1
+    journal = None
+    if options.directory:
+        journal = Journal(options.directory)
+        try:
+            recovered = journal.begin(options.resume)
+        except JournalBusy as e:
+            print("[error] {}".format(e), file=sys.stderr)
+            return 1
+        if recovered and options.verbose:
+            print("[info] recovered {} file(s) the last run left in flight"
+                .format(recovered), file=sys.stderr)
+    verifier = None
+    if options.verify:
+        if not decoder_available():
+            print("[error] please install Pillow to use --verify",
+                file=sys.stderr)
+            return 1
+        verifier = Verifier(options.verify, options.verify_sample / 100)
+
+    cache = open_cache() if options.cache else None
+    paths = [p for p in (options.filename, options.directory) if p]
+    # a thread per CPU; the scheduler holds back images that don't fit
+    scheduler = Scheduler()
+    workers = scheduler.cpus
+    # racing strategies already keep several cores busy per image
+    parallel = workers
+    if options.race:
+        parallel = max(1, workers // len(STRATEGIES["png"]))
+    model = EffortModel()
+    policy = EffortPolicy(model, options.effort, options.file_budget,
+        options.batch_budget, workers=parallel)
+    manifest = None
+    if options.changed_only and options.directory:
+        manifest = Manifest(options.directory)
+    images = iter_images(paths, options, cache, policy, manifest, verifier,
+        journal)
+    if options.batch_budget is not None:
+        # sharing out the budget needs to know how many images there are
+        images = sorted(images, key=lambda image: image.oldfilesize,
+            reverse=True)
+        policy.remaining = len(images)
+    else:
+        images = largest_first(images)
+    if journal is not None:
+        images = journaled(images, journal)
+
+    status = 0
+    totals = Totals()
+    for image in compress_images(images, workers, scheduler):
+        totals.add(image)
+        if manifest is not None:
+            manifest.record(image.fullpath, image.retcode)
+        if journal is not None:
+            journal.commit(image.fullpath, image.retcode)
+        if options.format == "jsonl":
+            print(json.dumps(result_record(image)), flush=True)
+        if image.retcode == 0:
+            if options.verbose and options.format == "text":
+                print(format_result(image))
+        elif image.verified is False:
+            status = 1
+            print("[error] {} looked different once optimized, kept the "
+                "original".format(image.fullpath), file=sys.stderr)
+        else:
+            status = 1
+            print("[error] {} could not be compressed".format(image.fullpath),
+                file=sys.stderr)
+    if options.format == "jsonl":
+        print(json.dumps(totals.record()), flush=True)
+    if verifier is not None and verifier.error is not None:
+        status = 1
+        print("[error] could not verify images, the files that were not "
+            "verified were kept: {}".format(verifier.error), file=sys.stderr)
+    if cache is not None:
+        cache.close()
+    if verifier is not None:
+        verifier.close()
+    model.close()
+    if manifest is not None:
+        manifest.close()
+    if journal is not None:
+        journal.close()
+    return status
+
+
+# subcommands, given as the first argument, and the module running each
+COMMANDS = {
+    "bench": "bench",
+    "queue": "distributed",
+    "serve": "server",
+    "watch": "watch",
+}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
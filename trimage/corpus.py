@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+"""
+Deterministic synthetic PNG and JPEG files for benchmarking.
+
+Everything is written in pure Python, so a corpus can be built on any
+machine without image libraries. The files are deliberately stored less
+efficiently than they could be (fast zlib settings, generic Huffman tables,
+redundant metadata) so the optimizers have something to do.
+"""
+
+import math
+import zlib
+import struct
+import random
+from os import path
+
+
+# name, kind, width, height, metadata
+CORPUS = [
+    ("gray-small", "gray", 64, 64, False),
+    ("gray16-medium", "gray16", 192, 128, True),
+    ("palette-small", "palette", 96, 96, False),
+    ("palette-medium", "palette", 256, 192, True),
+    ("rgb-small", "rgb", 80, 60, True),
+    ("rgb-large", "rgb", 480, 320, False),
+    ("rgba-medium", "rgba", 200, 200, True),
+    ("photo-gray", "jpeg-gray", 128, 96, False),
+    ("photo-small", "jpeg-color", 96, 64, True),
+    ("photo-medium", "jpeg-color", 320, 240, True),
+    ("photo-large", "jpeg-color", 480, 360, False),
+]
+
+
+def write_corpus(directory, copies=1, seed=0):
+    """
+    Write the corpus into directory and return the paths of the files.
+
+    The same seed always gives byte-identical files.
+    """
+    files = []
+    for copy in range(copies):
+        for name, kind, width, height, metadata in CORPUS:
+            rng = random.Random("{}-{}-{}".format(seed, copy, name))
+            if kind.startswith("jpeg"):
+                data = jpeg_bytes(width, height, kind == "jpeg-color",
+                    metadata, rng)
+                ext = ".jpg"
+            else:
+                data = png_bytes(width, height, kind, metadata, rng)
+                ext = ".png"
+            fullpath = path.join(directory, "{}-{}{}".format(name, copy, ext))
+            with open(fullpath, "wb") as f:
+                f.write(data)
+            files.append(fullpath)
+    return files
+
+
+def sample(x, y, width, height, rng, channel=0):
+    """A smooth pattern with some noise: compressible, but not trivially."""
+    value = (128 + 60 * math.sin((x + channel * 17) / (width / 6.0))
+        + 50 * math.cos(y / (height / 4.0)) + rng.randint(-6, 6))
+    return max(0, min(255, int(value)))
+
+
+"""
+PNG
+"""
+
+PNG_TYPES = {
+    # kind: (colour type, bit depth, channels)
+    "gray": (0, 8, 1),
+    "gray16": (0, 16, 1),
+    "rgb": (2, 8, 3),
+    "rgba": (6, 8, 4),
+    "palette": (3, 8, 1),
+}
+
+
+def png_chunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data
+        + struct.pack(">I", zlib.crc32(kind + data)))
+
+
+def png_bytes(width, height, kind, metadata, rng):
+    """Return a PNG of the given kind, optionally with ancillary chunks."""
+    colortype, depth, channels = PNG_TYPES[kind]
+    rows = []
+    for y in range(height):
+        row = bytearray([0])
+        for x in range(width):
+            for channel in range(channels):
+                value = sample(x, y, width, height, rng, channel)
+                if kind == "palette":
+                    value //= 16
+                elif kind == "rgba" and channel == 3:
+                    value = 255 if value > 63 else value * 4
+                row.append(value)
+                if depth == 16:
+                    row.append(rng.randrange(256))
+        rows.append(bytes(row))
+
+    chunks = [png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height,
+        depth, colortype, 0, 0, 0))]
+    if metadata:
+        chunks.append(png_chunk(b"gAMA", struct.pack(">I", 45455)))
+        chunks.append(png_chunk(b"pHYs", struct.pack(">IIB", 2835, 2835, 1)))
+        chunks.append(png_chunk(b"tIME", struct.pack(">HBBBBB",
+            2010, 3, 23, 20, 18, 17)))
+        chunks.append(png_chunk(b"tEXt",
+            b"Comment\0Synthetic benchmark image " * 8))
+    if kind == "palette":
+        chunks.append(png_chunk(b"PLTE", bytes(
+            component for i in range(16)
+            for component in (i * 16, 255 - i * 16, (i * 40) % 256))))
+    chunks.append(png_chunk(b"IDAT", zlib.compress(b"".join(rows), 1)))
+    chunks.append(png_chunk(b"IEND", b""))
+    return b"\x89PNG\r\n\x1a\n" + b"".join(chunks)
+
+
+"""
+JPEG: a small baseline encoder
+"""
+
+ZIGZAG = [
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63,
+]
+
+LUMA_QUANT = [
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+]
+
+CHROMA_QUANT = [
+    17, 18, 24, 47, 99, 99, 99, 99, 18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99, 47, 66, 99, 99, 99, 99, 99, 99,
+] + [99] * 32
+
+# Generic Huffman tables that give every symbol a code of the same length.
+# They are valid but wasteful, which leaves jpegoptim something to gain.
+DC_SYMBOLS = list(range(12))
+AC_SYMBOLS = [0x00, 0xf0] + [run << 4 | size
+    for run in range(16) for size in range(1, 11)]
+DC_LENGTH = 4
+AC_LENGTH = 8
+
+COSINES = [[(math.sqrt(0.5) if u == 0 else 1.0) / 2
+    * math.cos((2 * x + 1) * u * math.pi / 16) for x in range(8)]
+    for u in range(8)]
+
+
+def huffman_codes(symbols, length):
+    """Map each symbol to its (code, length) in a fixed length table."""
+    return {symbol: (code, length) for code, symbol in enumerate(symbols)}
+
+
+def huffman_segment(tableclass, symbols, length):
+    """Return the DHT segment for a fixed length table."""
+    counts = [0] * 16
+    counts[length - 1] = len(symbols)
+    data = bytes([tableclass << 4]) + bytes(counts) + bytes(symbols)
+    return b"\xff\xc4" + struct.pack(">H", len(data) + 2) + data
+
+
+def segment(marker, data):
+    return bytes([0xff, marker]) + struct.pack(">H", len(data) + 2) + data
+
+
+class BitWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.buffer = 0
+        self.count = 0
+
+    def write(self, value, length):
+        self.buffer = (self.buffer << length) | (value & ((1 << length) - 1))
+        self.count += length
+        while self.count >= 8:
+            self.count -= 8
+            byte = (self.buffer >> self.count) & 0xff
+            self.data.append(byte)
+            if byte == 0xff:
+                self.data.append(0)
+        self.buffer &= (1 << self.count) - 1
+
+    def flush(self):
+        if self.count:
+            self.write((1 << (8 - self.count)) - 1, 8 - self.count)
+        return bytes(self.data)
+
+
+def magnitude(value):
+    """Return the JPEG size category and the extra bits of value."""
+    size = abs(value).bit_length()
+    return size, value if value >= 0 else value + (1 << size) - 1
+
+
+def encode_block(block, quant, previous, writer, dc_codes, ac_codes):
+    """Transform, quantize and entropy code one 8x8 block; return its DC."""
+    rows = [[sum(COSINES[u][x] * block[y * 8 + x] for x in range(8))
+        for u in range(8)] for y in range(8)]
+    coefficients = [0] * 64
+    for v in range(8):
+        for u in range(8):
+            value = sum(COSINES[v][y] * rows[y][u] for y in range(8))
+            coefficients[v * 8 + u] = int(round(value / quant[v * 8 + u]))
+    zigzag = [coefficients[i] for i in ZIGZAG]
+
+    size, bits = magnitude(zigzag[0] - previous)
+    writer.write(*dc_codes[size])
+    writer.write(bits, size)
+
+    run = 0
+    for value in zigzag[1:]:
+        if value == 0:
+            run += 1
+            continue
+        while run > 15:
+            writer.write(*ac_codes[0xf0])
+            run -= 16
+        size, bits = magnitude(value)
+        writer.write(*ac_codes[run << 4 | size])
+        writer.write(bits, size)
+        run = 0
+    if run:
+        writer.write(*ac_codes[0x00])
+    return zigzag[0]
+
+
+def jpeg_bytes(width, height, color, metadata, rng):
+    """Return a baseline JPEG, optionally with EXIF, XMP and a comment."""
+    if color:
+        pixels = [[(sample(x, y, width, height, rng, 0),
+            sample(x, y, width, height, rng, 1),
+            sample(x, y, width, height, rng, 2))
+            for x in range(width)] for y in range(height)]
+        planes = [
+            [[0.299 * r + 0.587 * g + 0.114 * b - 128
+                for r, g, b in row] for row in pixels],
+            [[-0.1687 * r - 0.3313 * g + 0.5 * b
+                for r, g, b in row] for row in pixels],
+            [[0.5 * r - 0.4187 * g - 0.0813 * b
+                for r, g, b in row] for row in pixels],
+        ]
+        quants = [LUMA_QUANT, CHROMA_QUANT, CHROMA_QUANT]
+    else:
+        planes = [[[sample(x, y, width, height, rng) - 128
+            for x in range(width)] for y in range(height)]]
+        quants = [LUMA_QUANT]
+
+    dc_codes = huffman_codes(DC_SYMBOLS, DC_LENGTH)
+    ac_codes = huffman_codes(AC_SYMBOLS, AC_LENGTH)
+    writer = BitWriter()
+    previous = [0] * len(planes)
+    for by in range(0, height, 8):
+        for bx in range(0, width, 8):
+            for i, plane in enumerate(planes):
+                # repeat the edge pixels to fill partial blocks
+                block = [plane[min(by + y, height - 1)][min(bx + x, width - 1)]
+                    for y in range(8) for x in range(8)]
+                previous[i] = encode_block(block, quants[i], previous[i],
+                    writer, dc_codes, ac_codes)
+
+    out = [b"\xff\xd8", segment(0xe0, b"JFIF\0\x01\x01\0\0\x01\0\x01\0\0")]
+    if metadata:
+        exif = b"Exif\0\0II*\0" + struct.pack("<IH", 8, 0) + bytes(512)
+        out.append(segment(0xe1, exif))
+        out.append(segment(0xe1, b"http://ns.adobe.com/xap/1.0/\0"
+            + b"<x:xmpmeta xmlns:x='adobe:ns:meta/'></x:xmpmeta>" * 16))
+        out.append(segment(0xfe, b"Synthetic benchmark image " * 16))
+    for i, quant in enumerate(quants[:2]):
+        out.append(segment(0xdb, bytes([i]) + bytes(quant[z] for z in ZIGZAG)))
+    components = b"".join(bytes([i + 1, 0x11, min(i, 1)])
+        for i in range(len(planes)))
+    out.append(segment(0xc0, struct.pack(">BHHB", 8, height, width,
+        len(planes)) + components))
+    out.append(huffman_segment(0, DC_SYMBOLS, DC_LENGTH))
+    out.append(huffman_segment(1, AC_SYMBOLS, AC_LENGTH))
+    scan = b"".join(bytes([i + 1, 0x00]) for i in range(len(planes)))
+    out.append(segment(0xda, bytes([len(planes)]) + scan + b"\x00\x3f\x00"))
+    out.append(writer.flush())
+    out.append(b"\xff\xd9")
+    return b"".join(out)
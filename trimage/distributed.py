@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+"""
+`trimage queue`: spread the compression of a tree over several processes.
+
+A coordinator walks the tree and publishes one job per image; any number of
+workers, on this machine or on others that see the same files, claim jobs,
+compress them and report back. A claim is a lease that the worker keeps
+renewing while it works. If a worker dies, its lease runs out and the job is
+handed to the next worker, up to a limit of attempts. Results are fenced by
+attempt, so a worker that lost its lease can't report a job a second time.
+"""
+
+import os
+import sys
+import json
+import socket
+import sqlite3
+import threading
+from os import path
+from time import time, sleep
+from threading import Lock, Event
+from contextlib import contextmanager
+from collections import namedtuple
+from optparse import OptionParser
+
+from backends import BACKENDS, filetype_of
+from batch import scan, compress_image, result_record, add_cache_option
+from cache import default_cache_path
+from image import Image
+from scheduler import Scheduler
+from tools import VERSION, check_dependencies, open_cache
+
+
+Job = namedtuple("Job", "id path attempt")
+
+QUEUED, CLAIMED, DONE, FAILED = "queued", "claimed", "done", "failed"
+
+
+class SQLiteTransport:
+    """
+    A job queue in an SQLite database.
+
+    Several processes can share it on one machine; across machines, put it
+    on a filesystem with working locks, or plug in another transport with the
+    same methods in TRANSPORTS.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        if filename != ":memory:":
+            os.makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+        self.db = sqlite3.connect(filename, timeout=60,
+            isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta "
+                "(key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs "
+                "(id INTEGER PRIMARY KEY, path TEXT UNIQUE, state TEXT, "
+                "attempt INTEGER, max_attempts INTEGER, worker TEXT, "
+                "lease REAL, result TEXT, finished INTEGER)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state "
+                "ON jobs (state, lease)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_finished "
+                "ON jobs (finished)")
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements of a with block as one write transaction."""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def set_root(self, root):
+        """Record the directory the job paths are relative to."""
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)",
+                (root,))
+
+    def root(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta "
+                "WHERE key = 'root'").fetchone()
+        return row[0] if row else None
+
+    def publish(self, paths, max_attempts=3):
+        """
+        Queue a job per path. Paths already queued or failed are queued
+        again; ones a worker holds or has finished are left alone.
+        """
+        with self.transaction() as db:
+            db.executemany("INSERT INTO jobs (path, state, attempt, "
+                "max_attempts) VALUES (?, 'queued', 0, ?) "
+                "ON CONFLICT (path) DO UPDATE SET state = 'queued', "
+                "attempt = 0, max_attempts = excluded.max_attempts, "
+                "worker = NULL, lease = NULL, result = NULL, finished = NULL "
+                "WHERE jobs.state NOT IN ('claimed', 'done')",
+                ((p, max_attempts) for p in paths))
+
+    def claim(self, worker, lease):
+        """
+        Lease the next job to worker for lease seconds and return it, or
+        None if there is nothing to do right now.
+        """
+        now = time()
+        with self.transaction() as db:
+            # leases that ran out on their last attempt fail for good
+            self._finish(db, "SELECT id FROM jobs WHERE state = 'claimed' "
+                "AND lease < ? AND attempt >= max_attempts", (now,), FAILED,
+                json.dumps({"error": "lease expired"}))
+            row = db.execute("SELECT id, path, attempt FROM jobs "
+                "WHERE state = 'queued' OR (state = 'claimed' AND lease < ?) "
+                "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'claimed', worker = ?, "
+                "attempt = attempt + 1, lease = ? WHERE id = ?",
+                (worker, now + lease, row[0]))
+        return Job(row[0], row[1], row[2] + 1)
+
+    def renew(self, job, worker, lease):
+        """Extend the lease of job; return False if it was lost."""
+        with self.transaction() as db:
+            return db.execute("UPDATE jobs SET lease = ? WHERE id = ? AND "
+                "state = 'claimed' AND worker = ? AND attempt = ?",
+                (time() + lease, job.id, worker, job.attempt)).rowcount == 1
+
+    def complete(self, job, worker, record, ok):
+        """
+        Report the outcome of job. A failed job is queued again until it
+        runs out of attempts. Return False if the lease had been lost.
+        """
+        with self.transaction() as db:
+            current = db.execute("SELECT attempt, max_attempts FROM jobs "
+                "WHERE id = ? AND state = 'claimed' AND worker = ? AND "
+                "attempt = ?", (job.id, worker, job.attempt)).fetchone()
+            if current is None:
+                return False
+            if ok or current[0] >= current[1]:
+                self._finish(db, "SELECT ?", (job.id,),
+                    DONE if ok else FAILED, json.dumps(record))
+            else:
+                db.execute("UPDATE jobs SET state = 'queued', worker = NULL, "
+                    "lease = NULL WHERE id = ?", (job.id,))
+        return True
+
+    def _finish(self, db, query, args, state, result):
+        finished = db.execute("SELECT COALESCE(MAX(finished), 0) "
+            "FROM jobs").fetchone()[0]
+        for i, (id,) in enumerate(db.execute(query, args).fetchall()):
+            db.execute("UPDATE jobs SET state = ?, result = ?, lease = NULL, "
+                "finished = ? WHERE id = ?", (state, result,
+                finished + i + 1, id))
+
+    def results(self, after=0):
+        """Return (finished, path, state, record) for jobs finished after."""
+        with self.lock:
+            rows = self.db.execute("SELECT finished, path, state, result "
+                "FROM jobs WHERE finished > ? ORDER BY finished",
+                (after,)).fetchall()
+        return [(finished, p, state, json.loads(result))
+            for finished, p, state, result in rows]
+
+    def counts(self):
+        """Return the number of jobs in each state."""
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs "
+                "GROUP BY state").fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+# transports by URL scheme, e.g. sqlite:/shared/trimage-queue.sqlite
+TRANSPORTS = {
+    "sqlite": SQLiteTransport,
+}
+
+
+def open_transport(url):
+    """Open the transport a queue URL names; a bare path means SQLite."""
+    scheme, sep, rest = url.partition(":")
+    if sep and scheme in TRANSPORTS:
+        return TRANSPORTS[scheme](rest)
+    return SQLiteTransport(url)
+
+
+def build_parser():
+    parser = OptionParser(usage="%prog queue publish [options] DIRECTORY\n"
+        "       %prog queue work [options]\n"
+        "       %prog queue status [options]",
+        version="%prog " + VERSION,
+        description="Publish the images in a directory as jobs, work on the "
+            "jobs of a queue, or show how far a queue has got.")
+    parser.add_option("--queue", action="store", type="string", dest="queue",
+        default=default_cache_path("queue.sqlite"), metavar="URL",
+        help="the queue: a path or sqlite:PATH (default: %default)")
+    parser.add_option("--wait", action="store_true", dest="wait",
+        default=False, help="publish: print the results as JSON Lines until "
+            "every job is finished")
+    parser.add_option("--max-attempts", action="store", type="int",
+        dest="max_attempts", default=3, metavar="N", help="publish: give up "
+            "on a job after N attempts (default: %default)")
+    parser.add_option("--root", action="store", type="string", dest="root",
+        metavar="DIRECTORY", help="work: where this machine sees the "
+            "published directory, if not at the same path")
+    parser.add_option("-w", "--workers", action="store", type="int",
+        dest="workers", metavar="N", help="work: compress N images at once "
+            "(default: the CPUs this process may use)")
+    parser.add_option("--lease", action="store", type="float", dest="lease",
+        default=60.0, metavar="SECONDS", help="work: how long a claim lasts "
+            "without being renewed (default: %default)")
+    parser.add_option("--poll", action="store", type="float", dest="poll",
+        metavar="SECONDS", help="work: keep waiting for jobs, looking every "
+            "SECONDS, instead of exiting when the queue is empty")
+    add_cache_option(parser, "work: ")
+    return parser
+
+
+def publish(transport, directory, options):
+    """Queue the images in directory, relative to it."""
+    root = path.abspath(directory)
+    transport.set_root(root)
+    count = 0
+    batch = []
+    for fullpath in scan([root]):
+        # the workers check for the tools and write access themselves
+        filetype = filetype_of(fullpath)
+        if filetype is not None and BACKENDS[filetype].lossless:
+            batch.append(path.relpath(fullpath, root))
+        if len(batch) >= 1000:
+            transport.publish(batch, options.max_attempts)
+            count += len(batch)
+            batch = []
+    transport.publish(batch, options.max_attempts)
+    count += len(batch)
+    print("[info] published {} jobs".format(count), file=sys.stderr)
+    if not options.wait:
+        return 0
+
+    status = 0
+    after = 0
+    while True:
+        for after, relpath, state, record in transport.results(after):
+            status |= state != DONE
+            print(json.dumps(dict(record, path=relpath)), flush=True)
+        counts = transport.counts()
+        if not counts.get(QUEUED) and not counts.get(CLAIMED):
+            return status
+        sleep(1)
+
+
+def work(transport, options):
+    """Claim and compress jobs until the queue is empty."""
+    if not check_dependencies():
+        return 1
+    root = options.root or transport.root()
+    if root is None:
+        print("[error] nothing has been published to this queue",
+            file=sys.stderr)
+        return 1
+    cache = None
+    if options.cache:
+        cache = open_cache()
+    scheduler = Scheduler()
+    workers = options.workers or scheduler.cpus
+    name = "{}:{}".format(socket.gethostname(), os.getpid())
+    stop = Event()
+    failures = []
+
+    def renew(job, worker, done):
+        # renew well before the lease runs out
+        while not done.wait(options.lease / 3):
+            if not transport.renew(job, worker, options.lease):
+                return
+
+    def loop():
+        # each thread holds its own leases
+        worker = "{}:{}".format(name, threading.get_ident())
+        while not stop.is_set():
+            job = transport.claim(worker, options.lease)
+            if job is None:
+                if options.poll is None:
+                    return
+                stop.wait(options.poll)
+                continue
+            done = Event()
+            renewer = threading.Thread(target=renew, args=(job, worker, done),
+                daemon=True)
+            renewer.start()
+            try:
+                image = Image(path.join(root, job.path), cache)
+                if image.valid:
+                    compress_image(image, scheduler)
+                    record = result_record(image)
+                    ok = image.retcode == 0
+                else:
+                    record = {"error": "not a supported image file and/or "
+                        "not writable"}
+                    ok = False
+            finally:
+                done.set()
+                renewer.join()
+            if not transport.complete(job, worker, record, ok):
+                print("[error] lost the lease on {}".format(job.path),
+                    file=sys.stderr)
+            elif not ok:
+                failures.append(job.path)
+
+    threads = [threading.Thread(target=loop) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        # let the images in progress finish before the cache is closed;
+        # a second interrupt leaves their claims to run out instead
+        stop.set()
+        for thread in threads:
+            thread.join()
+        raise
+    finally:
+        if cache is not None:
+            cache.close()
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    options, args = parser.parse_args(argv)
+    if not args or args[0] not in ("publish", "work", "status"):
+        parser.error("expected publish, work or status")
+    if args[0] == "publish" and len(args) != 2:
+        parser.error("publish needs a directory")
+
+    transport = open_transport(options.queue)
+    try:
+        if args[0] == "publish":
+            return publish(transport, args[1], options)
+        if args[0] == "work":
+            return work(transport, options)
+        print(json.dumps(transport.counts(), sort_keys=True))
+        return 0
+    finally:
+        transport.close()
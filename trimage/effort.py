@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import struct
+import sqlite3
+from os import path
+from time import monotonic
+from threading import Lock
+from collections import namedtuple
+
+from cache import default_cache_path
+from pipeline import SIGNATURES, png_pipeline
+from tools import supported_level
+
+
+EFFORTS = ["fast", "balanced", "max"]
+
+# (optipng level, advpng level) from cheapest to most thorough
+LEVELS = [(1, 1), (2, 2), (3, 3), (5, 4), (7, 4)]
+
+# Used until the history holds enough runs: seconds per megabyte of raw
+# pixel data, and the fraction of the file saved, for each level.
+DEFAULT_SECONDS = [0.05, 0.2, 0.5, 2.0, 8.0]
+DEFAULT_GAINS = [0.0, 0.02, 0.03, 0.034, 0.036]
+
+# balanced effort only moves up a level if that saves this much more
+MIN_GAIN = 0.005
+MIN_RUNS = 3
+
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+Plan = namedtuple("Plan", "level sizeclass channels megabytes steps")
+Estimate = namedtuple("Estimate", "seconds gain")
+
+
+def png_header(fullpath):
+    """Return the width, height, bit depth and channels of a PNG, or None."""
+    with open(fullpath, "rb") as f:
+        head = f.read(26)
+    if len(head) < 26 or not head.startswith(SIGNATURES["png"]) \
+            or head[12:16] != b"IHDR":
+        return None
+    width, height, depth, colortype = struct.unpack(">IIBB", head[16:26])
+    return width, height, depth, PNG_CHANNELS.get(colortype, 4)
+
+
+class EffortModel:
+    """
+    History of how long each level took and how much it saved.
+
+    Runs are grouped by channel count and by the order of magnitude (base 2)
+    of the raw pixel data, since both decide how an image responds to more
+    effort.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or default_cache_path("effort.sqlite")
+        self.lock = Lock()
+        if self.filename != ":memory:":
+            os.makedirs(path.dirname(self.filename), exist_ok=True)
+        self.db = sqlite3.connect(self.filename, timeout=30,
+            check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS history "
+                "(level INTEGER, sizeclass INTEGER, channels INTEGER, "
+                "runs INTEGER, megabytes REAL, seconds REAL, gain REAL, "
+                "PRIMARY KEY (level, sizeclass, channels))")
+
+    def estimate(self, level, sizeclass, channels, megabytes):
+        """Predict the time and fractional saving of level for an image."""
+        with self.lock:
+            row = self.db.execute("SELECT runs, megabytes, seconds, gain "
+                "FROM history WHERE level = ? AND sizeclass = ? AND "
+                "channels = ?", (level, sizeclass, channels)).fetchone()
+        if row is None or row[0] < MIN_RUNS:
+            return Estimate(DEFAULT_SECONDS[level] * megabytes,
+                DEFAULT_GAINS[level])
+        runs, total_megabytes, seconds, gain = row
+        return Estimate(seconds / max(total_megabytes, 1e-6) * megabytes,
+            gain / runs)
+
+    def record(self, level, sizeclass, channels, megabytes, seconds, gain):
+        """Add the outcome of one run to the history."""
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO history VALUES (?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT (level, sizeclass, channels) DO UPDATE SET "
+                "runs = runs + 1, megabytes = megabytes + excluded.megabytes, "
+                "seconds = seconds + excluded.seconds, "
+                "gain = gain + excluded.gain",
+                (level, sizeclass, channels, megabytes, seconds, gain))
+
+    def close(self):
+        self.db.close()
+
+
+class EffortPolicy:
+    """
+    Choose the PNG optimization levels for each image.
+
+    fast always uses the cheapest level and max the most thorough one.
+    balanced moves up a level only while the history predicts it saves at
+    least MIN_GAIN more of the file. Any level predicted to take longer than
+    the time left for the image is skipped; with a batch budget that is the
+    remaining time shared between the workers and the images still to come.
+    """
+
+    def __init__(self, model, effort="max", file_budget=None,
+            batch_budget=None, files=0, workers=1):
+        if effort not in EFFORTS:
+            raise ValueError("unknown effort {}".format(effort))
+        self.model = model
+        self.effort = effort
+        self.file_budget = file_budget
+        self.deadline = None
+        if batch_budget is not None:
+            self.deadline = monotonic() + batch_budget
+        self.remaining = files
+        self.workers = workers
+        self.lock = Lock()
+        # the installed optimizers may not go as high as LEVELS does
+        self.levels = [(supported_level("optipng", optipng),
+            supported_level("advpng", advpng)) for optipng, advpng in LEVELS]
+
+    def budget(self):
+        """Return the seconds available for the next image, or None."""
+        with self.lock:
+            budget = self.file_budget
+            if self.deadline is not None:
+                left = max(0.0, self.deadline - monotonic())
+                share = left * self.workers / max(self.remaining, 1)
+                budget = share if budget is None else min(budget, share)
+            self.remaining = max(0, self.remaining - 1)
+        return budget
+
+    def plan(self, image):
+        """Return the Plan for image, or None to use the default pipeline."""
+        budget = self.budget()
+        if image.filetype != "png":
+            return None
+        header = png_header(image.fullpath)
+        if header is None:
+            return None
+        width, height, depth, channels = header
+        megabytes = width * height * depth * channels / 8 / 1e6
+        sizeclass = int(math.log2(megabytes * 1e6 + 1))
+        estimates = [self.model.estimate(level, sizeclass, channels, megabytes)
+            for level in range(len(LEVELS))]
+
+        if self.effort == "fast":
+            level = 0
+        elif self.effort == "max":
+            level = len(LEVELS) - 1
+        else:
+            level = 0
+            while level + 1 < len(LEVELS) and (estimates[level + 1].gain
+                    - estimates[level].gain) >= MIN_GAIN:
+                level += 1
+        if budget is not None:
+            while level > 0 and estimates[level].seconds > budget:
+                level -= 1
+        return Plan(level, sizeclass, channels, megabytes,
+            png_pipeline(*self.levels[level]))
+
+    def record(self, plan, seconds, gain):
+        """Teach the model how a planned run turned out."""
+        self.model.record(plan.level, plan.sizeclass, plan.channels,
+            plan.megabytes, seconds, gain)
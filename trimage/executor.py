@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import logging
+from queue import Full
+from threading import BoundedSemaphore, Event, Lock
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BoundedExecutor:
+    """
+    A thread pool that accepts a limited number of outstanding jobs.
+
+    At most max_workers jobs run at once and at most max_queued more wait
+    for a worker; submit blocks (or raises queue.Full) until a slot is free.
+    The number of unfinished jobs is tracked so callers can wait until the
+    pool is idle.
+    """
+
+    def __init__(self, max_workers=None, max_queued=None):
+        self.max_workers = max_workers or cpu_count()
+        if max_queued is None:
+            max_queued = self.max_workers * 2
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.slots = BoundedSemaphore(self.max_workers + max_queued)
+        self.lock = Lock()
+        self.pending = 0
+        self.idle = Event()
+        self.idle.set()
+
+    def submit(self, fn, *args, callback=None, block=True, timeout=None):
+        """
+        Schedule fn(*args) and return its future.
+
+        @param callback Called with the future once the job is done.
+        @param block Wait for a free slot instead of raising queue.Full.
+        """
+        if not self.slots.acquire(block, timeout):
+            raise Full("no free slot in the executor")
+        with self.lock:
+            self.pending += 1
+            self.idle.clear()
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self._finish()
+            raise
+        future.add_done_callback(lambda future: self._done(future, callback))
+        return future
+
+    def _done(self, future, callback):
+        # free the slot before running the callback, so a callback that
+        # waits on another submit can not deadlock the pool
+        self.slots.release()
+        try:
+            if callback is not None:
+                callback(future)
+        except Exception:
+            logging.getLogger("trimage.executor").exception(
+                "Error while delivering a result to its callback")
+        finally:
+            self._finish()
+
+    def _finish(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.idle.set()
+
+    def wait(self, timeout=None):
+        """Wait until every submitted job is done; return False on timeout."""
+        return self.idle.wait(timeout)
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop accepting jobs, optionally dropping the ones not started."""
+        self.executor.shutdown(wait=wait, cancel_futures=cancel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from os import path
+from time import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows; runs over the same tree are not kept apart there
+    fcntl = None
+
+from cache import default_cache_path
+from pipeline import RUN_ID, backup_path, copy_synced, temp_prefix
+
+
+QUEUED, STARTED, COMMITTED, FAILED = "queued", "started", "committed", "failed"
+
+
+class JournalBusy(Exception):
+    """Another process is running a batch with the same journal."""
+
+
+class Journal:
+    """
+    Write-ahead record of a batch over a tree.
+
+    Every image is recorded as queued when it is found, as started before it
+    is handed to a worker and as committed (or failed) once its result is
+    in. The state of an image is written before anything is done to the
+    file, so when a run is killed the journal knows which files finished and
+    which were in flight. The next run cleans up after the in-flight ones:
+    it puts back files that were being overwritten in place and removes the
+    temporary files of the dead process. A run that resumes also skips the
+    committed files that have not changed since. Every other file was
+    replaced atomically, so it is either as it was or fully optimized.
+
+    The journal lives in the cache directory, one SQLite database per tree
+    like the Manifest, with synchronous=NORMAL: it survives the process being
+    killed, not the machine losing power. The run using it holds a lock on
+    a file next to it, which the system drops when the process dies, so a
+    journal whose lock is free was left by a run that is over.
+    """
+
+    def __init__(self, root, filename=None, batch=1000):
+        self.root = path.abspath(root)
+        if filename is None:
+            key = hashlib.blake2b(self.root.encode("utf-8"),
+                digest_size=16).hexdigest()
+            filename = default_cache_path(path.join("journals",
+                key + ".sqlite"))
+        self.filename = filename
+        self.batch = batch
+        self.unsaved = []
+        self.lock = None
+
+        if self.filename != ":memory:":
+            os.makedirs(path.dirname(self.filename), exist_ok=True)
+        self.db = sqlite3.connect(self.filename, timeout=30,
+            isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta "
+            "(key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs "
+            "(path TEXT PRIMARY KEY, state TEXT, size INTEGER, "
+            "mtime INTEGER, retcode INTEGER, updated REAL) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state "
+            "ON jobs (state)")
+
+    def key(self, fullpath):
+        return path.relpath(path.abspath(fullpath), self.root)
+
+    def begin(self, resume=False):
+        """
+        Take the journal over for this run.
+
+        The files the last run left in flight are recovered. With resume
+        they are queued again and the rest of its record is kept; without
+        it the record is dropped. Return the number of files recovered.
+        Raise JournalBusy if another run holds the journal.
+        """
+        self.acquire()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT value FROM meta "
+                "WHERE key = 'run'").fetchone()
+            recovered = self.recover(row[0] if row else None)
+            if not resume:
+                self.db.execute("DELETE FROM jobs")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)",
+                (RUN_ID,))
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            self.release()
+            raise
+        self.db.execute("COMMIT")
+        return recovered
+
+    def acquire(self):
+        """Lock the journal for this run, or raise JournalBusy."""
+        if fcntl is None or self.filename == ":memory:":
+            return
+        self.lock = open(self.filename + ".lock", "a")
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.release()
+            raise JournalBusy("another run is compressing {}".format(
+                self.root))
+
+    def release(self):
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    def recover(self, run):
+        """
+        Clean up after the files the last run left in flight; run is its
+        RUN_ID, or None if it is not known.
+        """
+        inflight = [row[0] for row in self.db.execute("SELECT path FROM jobs "
+            "WHERE state = ?", (STARTED,))]
+        if run is not None:
+            for relpath in inflight:
+                fullpath = path.join(self.root, relpath)
+                backup = backup_path(fullpath, run)
+                if path.exists(backup):
+                    # the file was being overwritten in place, so it is torn
+                    copy_synced(backup, fullpath)
+                    os.remove(backup)
+                pattern = "." + temp_prefix(run) + "*"
+                for sibling in glob.glob(path.join(glob.escape(
+                        path.dirname(fullpath)), pattern)):
+                    os.remove(sibling)
+            for tempdir in glob.glob(path.join(glob.escape(
+                    tempfile.gettempdir()), temp_prefix(run) + "*")):
+                shutil.rmtree(tempdir, ignore_errors=True)
+            # backups the run was still writing
+            for partial in glob.glob(path.join(glob.escape(default_cache_path(
+                    "backups")), "." + temp_prefix(run) + "*")):
+                os.remove(partial)
+        self.db.execute("UPDATE jobs SET state = ? WHERE state = ?",
+            (QUEUED, STARTED))
+        return len(inflight)
+
+    def committed(self, fullpath):
+        """Return True if fullpath was committed and has not changed since."""
+        try:
+            st = os.stat(fullpath)
+        except OSError:
+            return False
+        row = self.db.execute("SELECT state, size, mtime FROM jobs "
+            "WHERE path = ?", (self.key(fullpath),)).fetchone()
+        return row == (COMMITTED, st.st_size, st.st_mtime_ns)
+
+    def queue(self, fullpath):
+        """Record that fullpath was found; written with the next start."""
+        self.unsaved.append((self.key(fullpath), QUEUED, None, None, None,
+            time()))
+        if len(self.unsaved) >= self.batch:
+            self.flush()
+
+    def start(self, fullpath):
+        """Record, before it is touched, that fullpath is being worked on."""
+        self.unsaved.append((self.key(fullpath), STARTED, None, None, None,
+            time()))
+        self.flush()
+
+    def commit(self, fullpath, retcode):
+        """Record the result of fullpath, and its size and mtime after it."""
+        try:
+            st = os.stat(fullpath)
+            size, mtime = st.st_size, st.st_mtime_ns
+        except OSError:
+            size = mtime = None
+        self.db.execute("INSERT OR REPLACE INTO jobs VALUES "
+            "(?, ?, ?, ?, ?, ?)", (self.key(fullpath),
+            COMMITTED if retcode == 0 else FAILED, size, mtime, retcode,
+            time()))
+
+    def flush(self):
+        if not self.unsaved:
+            return
+        self.db.execute("BEGIN")
+        self.db.executemany("INSERT OR REPLACE INTO jobs VALUES "
+            "(?, ?, ?, ?, ?, ?)", self.unsaved)
+        self.db.execute("COMMIT")
+        self.unsaved = []
+
+    def counts(self):
+        """Return the number of files in each state."""
+        self.flush()
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs "
+            "GROUP BY state").fetchall())
+
+    def close(self):
+        self.flush()
+        self.db.execute("DELETE FROM meta WHERE key = 'run'")
+        self.db.close()
+        self.release()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import hashlib
+from os import path
+
+from cache import default_cache_path
+
+
+class Manifest:
+    """
+    Size, modification time and last result of every file in a tree.
+
+    A file whose size and mtime still match its entry, and whose last run
+    succeeded, has not changed since and can be skipped without reading it.
+    The manifest lives in the cache directory, one SQLite database per tree,
+    so several runs over the same tree can write to it at once.
+    """
+
+    def __init__(self, root, filename=None, batch=100):
+        self.root = path.abspath(root)
+        if filename is None:
+            key = hashlib.blake2b(self.root.encode("utf-8"),
+                digest_size=16).hexdigest()
+            filename = default_cache_path(path.join("manifests",
+                key + ".sqlite"))
+        self.filename = filename
+        self.batch = batch
+        self.unsaved = []
+
+        if self.filename != ":memory:":
+            os.makedirs(path.dirname(self.filename), exist_ok=True)
+        self.db = sqlite3.connect(self.filename, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+            "result INTEGER) WITHOUT ROWID")
+        self.db.commit()
+
+    def key(self, fullpath):
+        return path.relpath(path.abspath(fullpath), self.root)
+
+    def unchanged(self, fullpath):
+        """Return True if fullpath is as the last successful run left it."""
+        try:
+            st = os.stat(fullpath)
+        except OSError:
+            return False
+        row = self.db.execute("SELECT size, mtime, result FROM files "
+            "WHERE path = ?", (self.key(fullpath),)).fetchone()
+        return row == (st.st_size, st.st_mtime_ns, 0)
+
+    def record(self, fullpath, result):
+        """Remember the current size and mtime of fullpath and its result."""
+        try:
+            st = os.stat(fullpath)
+        except OSError:
+            return
+        self.unsaved.append(
+            (self.key(fullpath), st.st_size, st.st_mtime_ns, result))
+        if len(self.unsaved) >= self.batch:
+            self.save()
+
+    def save(self):
+        """
+        Write the recorded results, so other runs can see them.
+
+        They are kept in memory until then, so the database is only locked
+        for one short transaction per batch.
+        """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files "
+                "VALUES (?, ?, ?, ?)", self.unsaved)
+        self.unsaved = []
+
+    def close(self):
+        self.save()
+        self.db.close()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+import os
+import errno
+import shutil
+import uuid
+import hashlib
+import tempfile
+from os import path
+from time import monotonic, sleep, thread_time
+from threading import Event
+from collections import namedtuple
+from subprocess import Popen, DEVNULL, TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cache import default_cache_path
+from strip import FINISHED, main_strip_jpeg, main_strip_png
+
+
+# How one step of a pipeline went: wall and CPU time are in seconds, the CPU
+# time being that of the tool's process itself.
+Step = namedtuple("Step", "tool retcode wall cpu strategy")
+
+
+# Every step is an argv list. "{file}" is replaced by the working copy of the
+# image; a step that writes "{output}" instead of working in place has that
+# file moved over the working copy once it succeeds. Steps named in BUILTINS
+# run inside trimage rather than as a separate process; one that returns
+# FINISHED ends the pipeline successfully.
+BUILTINS = {
+    "strip-jpeg": main_strip_jpeg,
+    "strip-png": main_strip_png,
+}
+
+# Removes the ancillary chunks pngcrush used to be run for, without another
+# recompression pass; the file is left alone if there are none.
+PNG_STRIP = ["strip-png", "{file}", "{output}"]
+
+
+def png_pipeline(optipng_level=7, advpng_level=4):
+    """Return the PNG pipeline at the given optimization levels."""
+    return [
+        ["optipng", "-force", "-o%d" % optipng_level, "{file}"],
+        ["advpng", "-z%d" % advpng_level, "{file}"],
+        PNG_STRIP,
+    ]
+
+
+def jpeg_pipeline(keep=()):
+    """
+    Return the JPEG pipeline, keeping the metadata named in keep (see
+    strip.JPEG_KEEP).
+
+    The metadata is removed in-process first, and jpegoptim only runs when
+    recoding the Huffman tables is expected to gain something.
+    """
+    if not keep:
+        return [
+            ["strip-jpeg", "{file}", "{output}"],
+            ["jpegoptim", "-f", "--strip-all", "{file}"],
+        ]
+    return [
+        ["strip-jpeg", "--keep=" + ",".join(sorted(keep)), "{file}",
+            "{output}"],
+        ["jpegoptim", "-f", "--strip-none", "{file}"],
+    ]
+
+
+PIPELINES = {
+    "jpeg": jpeg_pipeline(),
+    "png": png_pipeline(),
+}
+
+# Alternative pipelines raced against each other in race mode.
+STRATEGIES = {
+    "jpeg": {
+        "jpegoptim": PIPELINES["jpeg"],
+    },
+    "png": {
+        "default": PIPELINES["png"],
+        "optipng": [
+            ["optipng", "-force", "-o7", "{file}"],
+            PNG_STRIP,
+        ],
+        "advpng": [
+            ["advpng", "-z4", "{file}"],
+            PNG_STRIP,
+        ],
+        "pngcrush": [
+            ["pngcrush", "-reduce", "-rem", "gAMA", "-rem", "alla",
+                "-rem", "cHRM", "-rem", "iCCP", "-rem", "sRGB", "-rem", "time",
+                "{file}", "{output}"],
+        ],
+        "fast": png_pipeline(2, 4),
+    },
+}
+
+SIGNATURES = {
+    "jpeg": b"\xff\xd8\xff",
+    "png": b"\x89PNG\r\n\x1a\n",
+}
+
+
+# tells the temporary files of this process from those of any other, even
+# one that had the same pid, e.g. in a restarted container
+RUN_ID = uuid.uuid4().hex[:16]
+
+
+def temp_prefix(run=None):
+    """
+    Return the prefix of the temporary files and directories of a run (this
+    one by default), so the ones a killed run left behind can be told apart
+    and removed.
+    """
+    return "trimage-{}-".format(RUN_ID if run is None else run)
+
+
+def backup_path(fullpath, run=None):
+    """Return where fullpath is kept while it is being overwritten in place."""
+    key = hashlib.blake2b(
+        path.abspath(fullpath).encode("utf-8", "surrogateescape"),
+        digest_size=16).hexdigest()
+    return default_cache_path(path.join("backups", temp_prefix(run) + key))
+
+
+def describe(steps):
+    """Return a pipeline as a single readable string, e.g. for cache keys."""
+    return " && ".join(" ".join(argv) for argv in steps)
+
+
+def copy_to(fullpath, tempdir):
+    """
+    Copy fullpath into tempdir as the work copy the steps run on.
+
+    The copy keeps the extension, which some tools go by, but not the name,
+    so it can't collide with the {output} file of run_steps.
+    """
+    workfile = path.join(tempdir, "input" + path.splitext(fullpath)[1])
+    shutil.copyfile(fullpath, workfile)
+    return workfile
+
+
+def run_steps(steps, workfile, cancel=None, timings=None, strategy=None):
+    """
+    Run each step on workfile, stopping at the first one that fails.
+
+    Return the exit code of the last step that ran. Setting the cancel event
+    kills the running step and makes this return -1. If timings is a list, a
+    Step is appended to it for every step that ran.
+    """
+    output = path.join(path.dirname(workfile),
+        "output" + path.splitext(workfile)[1])
+    for argv in steps:
+        if cancel is not None and cancel.is_set():
+            return -1
+        argv = [arg.format(file=workfile, output=output) for arg in argv]
+        start = monotonic()
+        finished = False
+        if argv[0] in BUILTINS:
+            cpu = thread_time()
+            retcode = BUILTINS[argv[0]](argv[1:])
+            cpu = thread_time() - cpu
+            if retcode == FINISHED:
+                finished = True
+                retcode = 0
+        else:
+            retcode, cpu = wait(Popen(argv, stdout=DEVNULL, stderr=DEVNULL),
+                cancel)
+        if timings is not None:
+            timings.append(Step(argv[0], retcode, monotonic() - start, cpu,
+                strategy))
+        if retcode != 0:
+            return retcode
+        if path.exists(output):
+            os.replace(output, workfile)
+        if finished:
+            break
+    return 0
+
+
+def wait(process, cancel=None):
+    """
+    Wait for process, killing it if the cancel event gets set.
+
+    Return its exit code (-1 if it was killed) and the CPU time it used, or
+    None where the system does not report it (Windows).
+    """
+    if not hasattr(os, "wait4"):
+        return wait_portable(process, cancel), None
+    killed = False
+    while True:
+        flags = 0 if cancel is None or killed else os.WNOHANG
+        pid, status, usage = os.wait4(process.pid, flags)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            cpu = usage.ru_utime + usage.ru_stime
+            return (-1 if killed else process.returncode), cpu
+        if cancel.is_set():
+            process.kill()
+            killed = True
+        else:
+            sleep(0.05)
+
+
+def wait_portable(process, cancel=None):
+    """Wait for process like wait, but without its CPU time."""
+    killed = False
+    while True:
+        try:
+            retcode = process.wait(None if cancel is None or killed else 0.05)
+        except TimeoutExpired:
+            if cancel.is_set():
+                process.kill()
+                killed = True
+            continue
+        return -1 if killed else retcode
+
+
+def run_pipeline(steps, fullpath, timings=None, validate=None, verify=None):
+    """
+    Optimize fullpath with steps, working on a copy in a private directory.
+
+    The original is only replaced, atomically, when the result is smaller
+    and, if a validate function is given, passes it. Return the exit code of
+    the pipeline (-1 if the result was not valid) and the resulting size of
+    fullpath. See keep_smaller for verify.
+    """
+    tempdir = tempfile.mkdtemp(prefix=temp_prefix())
+    try:
+        workfile = copy_to(fullpath, tempdir)
+        retcode = run_steps(steps, workfile, timings=timings)
+        oldsize = path.getsize(fullpath)
+        if retcode != 0:
+            return retcode, oldsize
+        if validate is not None and not validate(workfile):
+            return -1, oldsize
+        return 0, keep_smaller(workfile, fullpath, verify, timings)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def race_pipelines(strategies, fullpath, validate, target=None,
+        timings=None, verify=None):
+    """
+    Run every strategy at once on its own copy of fullpath and keep the
+    smallest valid result.
+
+    @param strategies A dict of strategy name to pipeline steps.
+    @param validate A function telling whether a result is usable.
+    @param target Stop the other strategies as soon as one saves at least
+    this fraction of the file (e.g. 0.3 for 30%).
+    @param timings A list that gets a Step for every step of every strategy.
+    @param verify See keep_smaller.
+    Return the exit code, the resulting size of fullpath and the name of the
+    strategy whose output replaced it (None if the original was kept).
+    """
+    oldsize = path.getsize(fullpath)
+    cancel = Event()
+    tempdirs = []
+
+    def attempt(name, steps):
+        tempdir = tempfile.mkdtemp(prefix=temp_prefix())
+        tempdirs.append(tempdir)
+        workfile = copy_to(fullpath, tempdir)
+        return name, run_steps(steps, workfile, cancel, timings, name), \
+            workfile
+
+    best = None
+    retcode = -1
+    try:
+        with ThreadPoolExecutor(max_workers=len(strategies)) as pool:
+            futures = [pool.submit(attempt, name, steps)
+                for name, steps in strategies.items()]
+            for future in as_completed(futures):
+                name, code, workfile = future.result()
+                if code != 0 or not validate(workfile):
+                    if best is None:
+                        retcode = code or -1
+                    continue
+                retcode = 0
+                size = path.getsize(workfile)
+                if best is None or size < best[0]:
+                    best = (size, name, workfile)
+                if target is not None and size <= oldsize * (1 - target):
+                    cancel.set()
+        if best is None:
+            return retcode, oldsize, None
+        size, name, workfile = best
+        newsize = keep_smaller(workfile, fullpath, verify, timings, name)
+        return 0, newsize, name if newsize < oldsize else None
+    finally:
+        cancel.set()
+        for tempdir in tempdirs:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def keep_smaller(workfile, fullpath, verify=None, timings=None,
+        strategy=None):
+    """
+    Replace fullpath with workfile if that is smaller; return the new size.
+
+    @param verify A function called with fullpath, workfile, timings and
+    strategy before the replacement; fullpath is kept if it returns False.
+    """
+    oldsize = path.getsize(fullpath)
+    newsize = path.getsize(workfile)
+    if newsize >= oldsize:
+        return oldsize
+    if verify is not None and not verify(fullpath, workfile, timings,
+            strategy):
+        return oldsize
+    shutil.copymode(fullpath, workfile)
+    replace(workfile, fullpath)
+    return newsize
+
+
+def replace(source, destination):
+    """
+    Atomically replace destination with source.
+
+    The temporary directory may be on another filesystem, in which case
+    source is first copied next to destination. If that directory is not
+    writable either, destination is overwritten in place, see overwrite.
+    """
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    dirname = path.dirname(destination)
+    try:
+        fd, sibling = tempfile.mkstemp(prefix="." + temp_prefix(),
+            dir=dirname)
+    except OSError:
+        overwrite(source, destination)
+        return
+    try:
+        with os.fdopen(fd, "wb") as f, open(source, "rb") as src:
+            shutil.copyfileobj(src, f)
+        shutil.copymode(source, sibling)
+        os.replace(sibling, destination)
+    except BaseException:
+        os.remove(sibling)
+        raise
+
+
+def overwrite(source, destination):
+    """
+    Copy source over destination in place.
+
+    That is not atomic, so a copy of destination is kept at its backup_path
+    until it is done; the next run after this one was killed puts back any
+    backup it finds (see journal.py). The copy is written under another
+    name first, so a backup that exists is always complete.
+    """
+    backup = backup_path(destination)
+    os.makedirs(path.dirname(backup), exist_ok=True)
+    fd, partial = tempfile.mkstemp(prefix="." + path.basename(backup) + "-",
+        dir=path.dirname(backup))
+    os.close(fd)
+    try:
+        copy_synced(destination, partial)
+        os.replace(partial, backup)
+    except BaseException:
+        os.remove(partial)
+        raise
+    copy_synced(source, destination)
+    os.remove(backup)
+
+
+def copy_synced(source, destination):
+    """Copy the contents of source to destination and flush them to disk."""
+    with open(source, "rb") as src, open(destination, "wb") as f:
+        shutil.copyfileobj(src, f)
+        f.flush()
+        os.fsync(f.fileno())
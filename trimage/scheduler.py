@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import os
+import heapq
+import struct
+from os import path
+from itertools import count
+from threading import Condition
+from contextlib import contextmanager
+from collections import namedtuple
+from multiprocessing import cpu_count
+
+from backends import BACKENDS, default_pipeline, read_head
+from effort import png_header
+from pipeline import BUILTINS
+from strip import StripError, jpeg_segments, mapped
+
+
+# Memory of every tool process on top of what its backend declares.
+BASE_MEMORY = 8 << 20
+
+# Used when the dimensions of an image can't be read: raw pixel data per
+# byte of the file.
+PIXELS_PER_BYTE = 10
+
+# Share of the memory limit that compressions may use.
+MEMORY_SHARE = 0.75
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+Cost = namedtuple("Cost", "cpus memory")
+
+
+def cgroup_dirs(controller):
+    """
+    Yield the cgroup directories of this process for controller, innermost
+    first, on both cgroup v1 and v2 hierarchies.
+    """
+    try:
+        with open("/proc/self/cgroup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return
+    for line in lines:
+        hierarchy, controllers, group = line.split(":", 2)
+        if hierarchy == "0" and not controllers:
+            base = CGROUP_ROOT
+            if not path.exists(path.join(base, "cgroup.controllers")):
+                base = path.join(CGROUP_ROOT, "unified")
+        elif controller in controllers.split(","):
+            base = path.join(CGROUP_ROOT, controllers)
+            if not path.isdir(base):
+                base = path.join(CGROUP_ROOT, controller)
+        else:
+            continue
+        # inside a container the own group is often mounted as the root
+        group = group.strip("/")
+        while True:
+            yield path.join(base, group)
+            if not group:
+                break
+            group = path.dirname(group)
+
+
+def read_cgroup(directory, filename):
+    """Return the words of a cgroup file, or None if it is not there."""
+    try:
+        with open(path.join(directory, filename)) as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+
+def cpu_limit():
+    """Return the CPUs this process may use, honouring cgroup quotas."""
+    try:
+        cpus = float(len(os.sched_getaffinity(0)))
+    except AttributeError:
+        cpus = float(cpu_count())
+    for directory in cgroup_dirs("cpu"):
+        quota = read_cgroup(directory, "cpu.max")
+        if quota is None:
+            quota = (read_cgroup(directory, "cpu.cfs_quota_us") or []) \
+                + (read_cgroup(directory, "cpu.cfs_period_us") or [])
+        if len(quota) == 2 and quota[0].isdigit() and int(quota[1]) > 0:
+            cpus = min(cpus, int(quota[0]) / int(quota[1]))
+    return max(1, round(cpus))
+
+
+def memory_limit():
+    """Return the bytes of memory this process may use, or None."""
+    try:
+        limit = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        limit = None
+    for directory in cgroup_dirs("memory"):
+        for name in ("memory.max", "memory.limit_in_bytes"):
+            value = read_cgroup(directory, name)
+            if value and value[0].isdigit() \
+                    and (limit is None or int(value[0]) < limit):
+                limit = int(value[0])
+    return limit
+
+
+def raw_size(image):
+    """Return the size of the decoded pixels of image, or an estimate."""
+    try:
+        if image.filetype == "png":
+            header = png_header(image.fullpath)
+            if header is not None:
+                width, height, depth, channels = header
+                return width * height * max(depth, 8) // 8 * channels
+        elif image.filetype == "jpeg":
+            with mapped(image.fullpath) as data:
+                for marker, start, end in jpeg_segments(data):
+                    if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8,
+                            0xcc):
+                        height, width, components = struct.unpack_from(">HHB",
+                            data, start + 5)
+                        return width * height * components
+        elif image.filetype == "gif":
+            width, height = struct.unpack_from("<HH", read_head(
+                image.fullpath), 6)
+            return width * height * 4
+        elif image.filetype == "webp":
+            head = read_head(image.fullpath)
+            if head[12:16] == b"VP8X":
+                width = int.from_bytes(head[24:27], "little") + 1
+                height = int.from_bytes(head[27:30], "little") + 1
+            elif head[12:16] == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                width = (bits & 0x3fff) + 1
+                height = (bits >> 14 & 0x3fff) + 1
+            else:
+                width, height = struct.unpack_from("<HH", head, 26)
+                width &= 0x3fff
+                height &= 0x3fff
+            return width * height * 4
+    except (OSError, StripError, struct.error):
+        pass
+    return image.oldfilesize * PIXELS_PER_BYTE
+
+
+def pipeline_memory(steps, pixels, memory):
+    """
+    Return the memory a pipeline needs: none if it only runs builtins,
+    otherwise that of one tool process.
+    """
+    if all(argv[0] in BUILTINS for argv in steps):
+        return 0
+    return BASE_MEMORY + int(memory * pixels)
+
+
+class Scheduler:
+    """
+    Share the CPUs and memory of the machine between compressions.
+
+    Every image is given a cost: the CPUs its tools keep busy at once (one,
+    or one per strategy when racing) and the memory they need, estimated
+    from its dimensions and what its backend declares. An image only starts
+    once its cost fits into what is left, except when nothing else is
+    running, so images too big for the limits still get done, one at a time.
+    The limits default to what the cgroup of the process allows, so
+    containers are neither oversubscribed nor run out of memory.
+    """
+
+    def __init__(self, cpus=None, memory=None):
+        self.cpus = cpus or cpu_limit()
+        if memory is None:
+            memory = memory_limit()
+            if memory is not None:
+                memory = int(memory * MEMORY_SHARE)
+        self.memory = memory
+        self.free_cpus = self.cpus
+        self.free_memory = memory
+        self.running = 0
+        self.condition = Condition()
+
+    def cost(self, image):
+        """Return the Cost of compressing image."""
+        backend = BACKENDS[image.filetype]
+        pixels = raw_size(image)
+        if image.race:
+            strategies = backend.strategies.values()
+            return Cost(len(strategies), sum(pipeline_memory(steps, pixels,
+                backend.memory) for steps in strategies))
+        return Cost(1, pipeline_memory(default_pipeline(backend), pixels,
+            backend.memory))
+
+    def fits(self, cost):
+        if self.running == 0:
+            return True
+        return cost.cpus <= self.free_cpus and (self.free_memory is None
+            or cost.memory <= self.free_memory)
+
+    @contextmanager
+    def reserve(self, image):
+        """Wait until there is room for image and hold it meanwhile."""
+        cost = self.cost(image)
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(cost))
+            self.running += 1
+            self.free_cpus -= cost.cpus
+            if self.free_memory is not None:
+                self.free_memory -= cost.memory
+        try:
+            yield cost
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.free_cpus += cost.cpus
+                if self.free_memory is not None:
+                    self.free_memory += cost.memory
+                self.condition.notify_all()
+
+
+def largest_first(images, window=256):
+    """
+    Yield images biggest file first, looking at most window images ahead.
+
+    Starting the slowest images first keeps a batch from ending with one
+    large file running alone, without having to read all the images
+    before the first one can start.
+    """
+    heap = []
+    order = count()
+    for image in images:
+        heapq.heappush(heap, (-image.oldfilesize, next(order), image))
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+"""
+`trimage serve`: a local HTTP service that compresses images sent to it.
+
+POST an image of any type a backend handles to /optimize and the response
+is the compressed image, with the sizes in X-Trimage-* headers. GET
+/metrics returns the counters of the service as JSON. Bodies are streamed
+to and from temporary files, so memory use does not grow with the size of
+the images.
+"""
+
+import os
+import sys
+import json
+import shutil
+import signal
+import asyncio
+import tempfile
+from os import path
+from time import monotonic
+from optparse import OptionParser
+from urllib.parse import urlsplit, parse_qs
+
+from backends import (BACKENDS, sniff, register, jpeg_backend,
+    keep_policy)
+from batch import compress_image, add_common_options
+from executor import BoundedExecutor
+from image import Image
+from scheduler import Scheduler, cpu_limit
+from tools import VERSION, check_dependencies, open_cache
+
+
+CHUNK = 1 << 16
+
+# media types clients send besides the ones the backends declare
+CONTENT_TYPE_ALIASES = {
+    "image/jpg": "jpeg",
+}
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    422: "Unprocessable Entity",
+    431: "Request Header Fields Too Large",
+    503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or REASONS[status])
+        self.status = status
+
+
+class Metrics:
+    """Counters of the service, as reported by /metrics."""
+
+    def __init__(self, concurrency, max_queue):
+        self.start = monotonic()
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queued = 0
+        self.running = 0
+        self.requests = 0
+        self.optimized = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.compress_seconds = 0.0
+
+    def record(self):
+        done = max(self.optimized + self.failed, 1)
+        return {
+            "uptime": round(monotonic() - self.start, 3),
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "running": self.running,
+            "requests": self.requests,
+            "optimized": self.optimized,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "saved_bytes": self.bytes_in - self.bytes_out,
+            "mean_wait_seconds": round(self.wait_seconds / done, 6),
+            "max_wait_seconds": round(self.max_wait_seconds, 6),
+            "mean_compress_seconds": round(self.compress_seconds / done, 6),
+        }
+
+
+class Server:
+    """
+    Handle one request per connection.
+
+    At most concurrency images are compressed at once, on a pool shared by
+    all requests; up to max_queue more are being uploaded or wait their
+    turn, and any beyond that are turned away with 503 before their body is
+    read, so a burst can't pile up without bound.
+    """
+
+    def __init__(self, concurrency, max_queue, max_body, cache=None,
+            lossy=False):
+        self.max_body = max_body
+        self.cache = cache
+        self.lossy = lossy
+        self.scheduler = Scheduler()
+        self.executor = BoundedExecutor(concurrency, max_queued=0)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.metrics = Metrics(concurrency, max_queue)
+
+    async def handle(self, reader, writer):
+        tempdir = None
+        try:
+            try:
+                method, target, headers = await self.read_head(reader)
+                url = urlsplit(target)
+                if url.path == "/metrics" and method == "GET":
+                    await self.respond(writer, 200, json.dumps(
+                        self.metrics.record()).encode("utf-8"),
+                        "application/json")
+                elif url.path == "/health" and method == "GET":
+                    await self.respond(writer, 200, b"ok\n", "text/plain")
+                elif url.path == "/optimize":
+                    if method != "POST":
+                        raise HTTPError(405)
+                    self.metrics.requests += 1
+                    tempdir = tempfile.mkdtemp(prefix="trimage-serve-")
+                    await self.optimize(reader, writer, headers,
+                        parse_qs(url.query), tempdir)
+                else:
+                    raise HTTPError(404)
+            except HTTPError as e:
+                if e.status in (413, 503):
+                    self.metrics.rejected += 1
+                await self.respond(writer, e.status,
+                    (str(e) + "\n").encode("utf-8"), "text/plain")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if tempdir is not None:
+                shutil.rmtree(tempdir, ignore_errors=True)
+            writer.close()
+
+    async def read_head(self, reader):
+        """Return the method, target and headers of a request."""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431)
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise HTTPError(400)
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        return method, target, headers
+
+    async def optimize(self, reader, writer, headers, query, tempdir):
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise HTTPError(411)
+        try:
+            length = int(headers["content-length"])
+        except (KeyError, ValueError):
+            raise HTTPError(411)
+        if length < 0:
+            raise HTTPError(400, "negative Content-Length")
+        if length > self.max_body:
+            raise HTTPError(413, "at most {} bytes".format(self.max_body))
+        metrics = self.metrics
+        if metrics.queued + metrics.running >= \
+                metrics.max_queue + metrics.concurrency:
+            raise HTTPError(503, "too many requests waiting")
+        # counted as queued from here, so uploads in progress take a place
+        metrics.queued += 1
+        try:
+            image, backend = await self.receive(reader, writer, headers,
+                query, tempdir, length)
+            arrived = monotonic()
+            await self.slots.acquire()
+        finally:
+            metrics.queued -= 1
+        try:
+            waited = monotonic() - arrived
+            metrics.wait_seconds += waited
+            metrics.max_wait_seconds = max(metrics.max_wait_seconds, waited)
+            metrics.running += 1
+            await asyncio.wrap_future(self.executor.submit(compress_image,
+                image, self.scheduler))
+        finally:
+            metrics.running -= 1
+            self.slots.release()
+        metrics.compress_seconds += image.seconds
+        if image.retcode != 0:
+            metrics.failed += 1
+            raise HTTPError(422, "the image could not be compressed")
+
+        metrics.optimized += 1
+        metrics.bytes_in += image.oldfilesize
+        metrics.bytes_out += image.newfilesize
+        saved = image.oldfilesize - image.newfilesize
+        await self.respond(writer, 200, image.fullpath, backend.media_type, {
+            "X-Trimage-Original-Size": image.oldfilesize,
+            "X-Trimage-Optimized-Size": image.newfilesize,
+            "X-Trimage-Saved-Bytes": saved,
+            "X-Trimage-Saved-Percent": "%.1f" % (
+                100.0 * saved / max(image.oldfilesize, 1)),
+            "X-Trimage-Seconds": "%.3f" % image.seconds,
+            "X-Trimage-Cached": "true" if image.cached else "false",
+        })
+
+    async def receive(self, reader, writer, headers, query, tempdir, length):
+        """
+        Stream the body of a request to tempdir; return it as an Image, with
+        its backend.
+        """
+        content_types = dict(CONTENT_TYPE_ALIASES, **{backend.media_type:
+            filetype for filetype, backend in BACKENDS.items()})
+        filetype = (query.get("type", [None])[0]
+            or content_types.get(headers.get("content-type", "")
+                .split(";")[0].strip().lower()))
+        if filetype == "jpg":
+            filetype = "jpeg"
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        # stream the body to disk, sniffing the type from its first bytes
+        upload = path.join(tempdir, "upload")
+        with open(upload, "wb") as f:
+            left = length
+            while left:
+                chunk = await reader.read(min(CHUNK, left))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", left)
+                if left == length and filetype is None:
+                    filetype = sniff(chunk)
+                f.write(chunk)
+                left -= len(chunk)
+        if filetype not in BACKENDS:
+            raise HTTPError(415, "not a supported image type")
+        backend = BACKENDS[filetype]
+        fullpath = upload + "." + backend.extensions[0]
+        os.rename(upload, fullpath)
+        image = Image(fullpath, self.cache, lossy=self.lossy)
+        if not image.valid:
+            if not (backend.lossless or self.lossy):
+                raise HTTPError(415, "the optimizer for {} images is not "
+                    "lossless, see --lossy".format(filetype))
+            raise HTTPError(415, "no optimizer for {} images is installed"
+                .format(filetype))
+        return image, backend
+
+    async def respond(self, writer, status, body, content_type, extra=None):
+        """Send a response; body is bytes or the path of a file to stream."""
+        if isinstance(body, bytes):
+            length = len(body)
+        else:
+            length = path.getsize(body)
+        head = ["HTTP/1.1 {} {}".format(status, REASONS[status]),
+            "Content-Type: " + content_type,
+            "Content-Length: {}".format(length),
+            "Connection: close"]
+        head += ["{}: {}".format(name, value)
+            for name, value in (extra or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        if isinstance(body, bytes):
+            writer.write(body)
+        else:
+            with open(body, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK), b""):
+                    writer.write(chunk)
+                    await writer.drain()
+        await writer.drain()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel=True)
+
+
+def build_parser():
+    parser = OptionParser(usage="%prog serve [options]",
+        version="%prog " + VERSION,
+        description="Serve POST /optimize on a local port: the request body "
+            "is an image, the response the compressed image. "
+            "GET /metrics reports the counters of the service.")
+    parser.add_option("--host", action="store", type="string", dest="host",
+        default="127.0.0.1", help="address to listen on (default: %default)")
+    parser.add_option("-p", "--port", action="store", type="int",
+        dest="port", default=8765, help="port to listen on "
+            "(default: %default)")
+    parser.add_option("-c", "--concurrency", action="store", type="int",
+        dest="concurrency", metavar="N", help="compress at most N images at "
+            "once (default: the CPUs this process may use)")
+    parser.add_option("--max-queue", action="store", type="int",
+        dest="max_queue", default=64, metavar="N", help="turn requests away "
+            "when N are already being uploaded or waiting (default: "
+            "%default)")
+    parser.add_option("--max-body", action="store", type="int",
+        dest="max_body", default=50 << 20, metavar="BYTES",
+        help="largest image accepted (default: %default)")
+    add_common_options(parser)
+    return parser
+
+
+async def serve(options, cache):
+    server = Server(options.concurrency or cpu_limit(),
+        options.max_queue, options.max_body, cache, options.lossy)
+    listener = await asyncio.start_server(server.handle, options.host,
+        options.port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    print("[info] listening on http://{}:{}/".format(options.host,
+        options.port), file=sys.stderr)
+    async with listener:
+        await stop.wait()
+    server.close()
+
+
+def main(argv=None):
+    parser = build_parser()
+    options, args = parser.parse_args(argv)
+    try:
+        register(jpeg_backend(keep_policy(options.keep_metadata)))
+    except ValueError as e:
+        parser.error(str(e))
+    if not check_dependencies():
+        return 1
+    cache = None
+    if options.cache:
+        cache = open_cache()
+    try:
+        asyncio.run(serve(options, cache))
+    except OSError as e:
+        print("[error] can't listen on {}:{}: {}".format(options.host,
+            options.port, e.strerror), file=sys.stderr)
+        return 1
+    finally:
+        if cache is not None:
+            cache.close()
+    return 0
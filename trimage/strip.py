@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+"""
+Metadata strippers that run inside trimage instead of as external tools.
+
+They work on a memory map of the input and write the parts that are kept
+straight from it, in a single pass, so removing metadata costs no more than
+copying the file once.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+from contextlib import contextmanager
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Ancillary chunks that are always kept: transparency is part of the image,
+# and the APNG chunks hold the frames of an animation.
+PNG_KEEP = frozenset([b"tRNS", b"acTL", b"fcTL", b"fdAT"])
+
+# Exit code of a step that finished the job, so the rest of the pipeline
+# would gain nothing.
+FINISHED = 3
+
+# What can be kept of the metadata of a JPEG: the EXIF orientation (as a
+# minimal EXIF segment holding nothing else) and the ICC colour profile.
+JPEG_KEEP = frozenset(["orientation", "icc"])
+
+SOS = 0xda
+COM = 0xfe
+APP0, APP1, APP2, APP14, APP15 = 0xe0, 0xe1, 0xe2, 0xee, 0xef
+EXIF_HEADER = b"Exif\0\0"
+ICC_HEADER = b"ICC_PROFILE\0"
+
+# Huffman tables that list every possible symbol, like the example tables of
+# the JPEG standard, were not fitted to the image by the encoder.
+GENERIC_TABLE_SYMBOLS = {0: 12, 1: 162}
+
+
+class StripError(ValueError):
+    """The input is not a well formed file of its type."""
+
+
+@contextmanager
+def mapped(fullpath):
+    """Map fullpath read-only and yield a memoryview of it."""
+    with open(fullpath, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            yield memoryview(b"")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            view = memoryview(m)
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+def png_chunks(data):
+    """
+    Yield the type and the whole extent (start, end) of each PNG chunk.
+
+    Every CRC is checked; a damaged or truncated file raises StripError.
+    """
+    if bytes(data[:8]) != PNG_SIGNATURE:
+        raise StripError("not a PNG file")
+    offset = 8
+    while offset < len(data):
+        if offset + 12 > len(data):
+            raise StripError("truncated chunk at {}".format(offset))
+        length, = struct.unpack_from(">I", data, offset)
+        end = offset + 12 + length
+        if end > len(data):
+            raise StripError("truncated chunk at {}".format(offset))
+        kind = bytes(data[offset + 4:offset + 8])
+        crc, = struct.unpack_from(">I", data, end - 4)
+        if zlib.crc32(data[offset + 4:end - 4]) != crc:
+            raise StripError("bad CRC in {} chunk at {}".format(
+                kind.decode("latin-1"), offset))
+        yield kind, offset, end
+        offset = end
+        if kind == b"IEND":
+            break
+
+
+def strip_png(source, output, keep=PNG_KEEP):
+    """
+    Copy source to output without its ancillary chunks, except keep.
+
+    Critical chunks (those whose type starts with an upper case letter) are
+    always copied, as is anything after IEND. Return the number of chunks
+    removed; when that is 0 no output is written.
+    """
+    keep = PNG_KEEP | set(keep)
+    with mapped(source) as data:
+        kept = []
+        removed = 0
+        end = 8
+        for kind, start, end in png_chunks(data):
+            if kind[0] & 0x20 and kind not in keep:
+                removed += 1
+            elif kept and kept[-1][1] == start:
+                # extend the previous run instead of starting a new one
+                kept[-1] = (kept[-1][0], end)
+            else:
+                kept.append((start, end))
+        if not removed:
+            return 0
+        with open(output, "wb") as f:
+            f.write(data[:8])
+            for start, stop in kept:
+                f.write(data[start:stop])
+            f.write(data[end:])
+        return removed
+
+
+def jpeg_segments(data):
+    """
+    Yield the marker and the extent (start, end) of each JPEG segment
+    before the image data, which is yielded last as (SOS, start, len(data)).
+    Fill bytes before a marker are left out of its extent.
+    """
+    if bytes(data[:2]) != b"\xff\xd8":
+        raise StripError("not a JPEG file")
+    offset = 2
+    while True:
+        # markers may be preceded by any number of 0xff fill bytes
+        start = offset
+        while offset < len(data) and data[offset] == 0xff:
+            offset += 1
+        if offset == start or offset + 2 >= len(data):
+            raise StripError("bad marker at {}".format(start))
+        marker = data[offset]
+        length, = struct.unpack_from(">H", data, offset + 1)
+        end = offset + 1 + length
+        if length < 2 or end > len(data):
+            raise StripError("truncated segment at {}".format(start))
+        if marker == SOS:
+            yield marker, offset - 1, len(data)
+            return
+        yield marker, offset - 1, end
+        offset = end
+
+
+def exif_orientation(exif):
+    """Return the orientation tag of an EXIF segment body, or None."""
+    tiff = exif[len(EXIF_HEADER):]
+    try:
+        order = {b"II": "<", b"MM": ">"}[bytes(tiff[:2])]
+        ifd, = struct.unpack_from(order + "I", tiff, 4)
+        count, = struct.unpack_from(order + "H", tiff, ifd)
+        for i in range(count):
+            tag, kind, _, value = struct.unpack_from(order + "HHIH", tiff,
+                ifd + 2 + i * 12)
+            if tag == 0x0112 and kind == 3:
+                return value
+    except (KeyError, struct.error):
+        pass
+    return None
+
+
+def orientation_segment(orientation):
+    """Return an APP1 segment whose EXIF holds only the orientation."""
+    body = (EXIF_HEADER + b"MM\0*" + struct.pack(">IH", 8, 1)
+        + struct.pack(">HHIHH", 0x0112, 3, 1, orientation, 0)
+        + struct.pack(">I", 0))
+    return struct.pack(">BBH", 0xff, APP1, len(body) + 2) + body
+
+
+def generic_tables(data, start, end):
+    """Return True if a DHT segment holds a table listing every symbol."""
+    offset = start + 4
+    while offset + 17 <= end:
+        tableclass = data[offset] >> 4
+        count = sum(data[offset + 1:offset + 17])
+        if count >= GENERIC_TABLE_SYMBOLS.get(tableclass, 256):
+            return True
+        offset += 17 + count
+    return False
+
+
+def strip_jpeg(source, output, keep=()):
+    """
+    Copy source to output without its metadata segments.
+
+    APP0 (JFIF) and APP14 (Adobe, which tells how the colours are stored)
+    are always kept; of the other APPn and COM segments, keep names what to
+    retain from JPEG_KEEP. No output is written if nothing is removed.
+
+    Return the number of segments removed and whether recoding the Huffman
+    tables, as jpegoptim does, is predicted to make the file smaller. That
+    is the case when the tables are generic rather than fitted to the image,
+    and never for arithmetic coded files.
+    """
+    with mapped(source) as data:
+        # extents of the input to copy, and new segments as bytes
+        kept = []
+        removed = 0
+        orientation = None
+        huffman = arithmetic = False
+        for marker, start, end in jpeg_segments(data):
+            if orientation not in (None, 1) and marker not in (APP0, APP1):
+                # the EXIF segment goes right after JFIF
+                kept.append(orientation_segment(orientation))
+                orientation = None
+            if marker == 0xc4:
+                huffman = huffman or generic_tables(data, start, end)
+            elif 0xc9 <= marker <= 0xcf and marker != 0xcc:
+                arithmetic = True
+            if (APP0 < marker <= APP15 and marker != APP14) or marker == COM:
+                head = bytes(data[start + 4:start + 16])
+                if marker == APP1 and "orientation" in keep \
+                        and head.startswith(EXIF_HEADER):
+                    orientation = exif_orientation(bytes(data[start + 4:end]))
+                elif marker == APP2 and "icc" in keep \
+                        and head == ICC_HEADER:
+                    kept.append((start, end))
+                    continue
+                removed += 1
+                continue
+            kept.append((start, end))
+        if not removed:
+            return 0, huffman and not arithmetic
+        with open(output, "wb") as f:
+            f.write(data[:2])
+            for extent in kept:
+                if isinstance(extent, bytes):
+                    f.write(extent)
+                else:
+                    f.write(data[extent[0]:extent[1]])
+        return removed, huffman and not arithmetic
+
+
+def main_strip_jpeg(args):
+    """
+    strip-jpeg [--keep=orientation,icc] FILE OUTPUT: a pipeline step.
+
+    Return FINISHED if jpegoptim is not expected to gain anything more. A
+    file that can not be parsed is left to the next step.
+    """
+    keep = set()
+    if args and args[0].startswith("--keep="):
+        keep = set(args.pop(0)[7:].split(",")) & JPEG_KEEP
+    source, output = args
+    try:
+        removed, huffman = strip_jpeg(source, output, keep)
+    except StripError:
+        return 0
+    return 0 if huffman else FINISHED
+
+
+def main_strip_png(args):
+    """
+    strip-png [--keep=tRNS,pHYs] FILE OUTPUT: a pipeline step.
+
+    Return 0 on success and 1 if FILE is not a valid PNG.
+    """
+    keep = set()
+    if args and args[0].startswith("--keep="):
+        keep = {name.encode("ascii") for name in args.pop(0)[7:].split(",")
+            if name}
+    source, output = args
+    try:
+        strip_png(source, output, keep)
+    except StripError:
+        return 1
+    return 0
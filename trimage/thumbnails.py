@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import hashlib
+from os import path
+from queue import Full
+from threading import Lock
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QSize, Qt, pyqtSignal
+from PyQt5.QtGui import QIcon, QImage, QImageReader, QPixmap
+
+from executor import BoundedExecutor
+
+
+THUMBNAIL_SIZE = 32
+# how many thumbnails are stored on disk between two trims
+TRIM_EVERY = 100
+
+
+class Thumbnails(QObject):
+    """
+    Small icons of images, made on demand in background threads.
+
+    An icon is only made when the table asks for it, which it does for the
+    rows in view. Images are decoded straight to thumbnail size where the
+    format allows it (JPEG does), and at most max_icons icons are kept, the
+    least recently shown ones being dropped first. With a directory, the
+    thumbnails are also stored on disk, keyed by path, size and mtime, so
+    they survive a restart. Storing one replaces the thumbnail of an older
+    version of the same file, and the least recently used ones are deleted
+    once they take up more than max_disk bytes, checked at startup and after
+    every TRIM_EVERY thumbnails stored. Images that can not be decoded are
+    not tried again until they change.
+    """
+
+    ready = pyqtSignal(str)
+    decoded = pyqtSignal(str, QImage)
+
+    def __init__(self, directory=None, max_icons=500, max_pending=100,
+            workers=2, max_disk=20 << 20):
+        QObject.__init__(self)
+        self.directory = directory
+        self.max_icons = max_icons
+        self.max_disk = max_disk
+        self.max_pending = max_pending
+        self.icons = OrderedDict()
+        # requests not started yet, the newest is made first; the ones that
+        # fall off the end are asked for again if their row is painted again
+        self.pending = OrderedDict()
+        # the size and mtime of the max_icons images last found unreadable
+        self.unreadable = OrderedDict()
+        self.saved = 0
+        self.lock = Lock()
+        self.executor = BoundedExecutor(max_workers=workers,
+            max_queued=max_pending)
+        self.decoded.connect(self.add_icon)
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.executor.submit(self.trim)
+
+    def icon(self, fullpath):
+        """Return the icon of fullpath, or None while it is made."""
+        icon = self.icons.get(fullpath)
+        if icon is not None:
+            self.icons.move_to_end(fullpath)
+            return icon
+        with self.lock:
+            if fullpath in self.unreadable:
+                if self.unreadable[fullpath] == stamp(fullpath):
+                    return None
+                del self.unreadable[fullpath]
+            if fullpath in self.pending:
+                self.pending.move_to_end(fullpath)
+                return None
+            self.pending[fullpath] = None
+            if len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                return None
+        try:
+            self.executor.submit(self.make_next, block=False)
+        except Full:
+            pass # a job already queued will get to it
+        return None
+
+    def make_next(self):
+        """Make the most recently requested thumbnail."""
+        with self.lock:
+            if not self.pending:
+                return
+            fullpath, _ = self.pending.popitem()
+        version = stamp(fullpath)
+        thumbnail = self.read(fullpath)
+        if thumbnail is None:
+            with self.lock:
+                self.unreadable[fullpath] = version
+                self.unreadable.move_to_end(fullpath)
+                while len(self.unreadable) > self.max_icons:
+                    self.unreadable.popitem(last=False)
+        else:
+            self.decoded.emit(fullpath, thumbnail)
+
+    def add_icon(self, fullpath, thumbnail):
+        """Turn a thumbnail into an icon; runs in the GUI thread."""
+        self.icons[fullpath] = QIcon(QPixmap.fromImage(thumbnail))
+        while len(self.icons) > self.max_icons:
+            self.icons.popitem(last=False)
+        self.ready.emit(fullpath)
+
+    def disk_path(self, fullpath):
+        """Return where the thumbnail of fullpath is stored, or None."""
+        if self.directory is None:
+            return None
+        version = stamp(fullpath)
+        if version is None:
+            return None
+        # all versions of a file share the first half of the name
+        return path.join(self.directory, "{}-{}.png".format(
+            digest(fullpath), digest("{}\0{}".format(*version))))
+
+    def read(self, fullpath):
+        """Return a QImage of fullpath at thumbnail size, or None."""
+        stored = self.disk_path(fullpath)
+        if stored is not None and path.exists(stored):
+            thumbnail = QImage(stored)
+            if not thumbnail.isNull():
+                # its mtime tells trim when it was last used
+                try:
+                    os.utime(stored)
+                except OSError:
+                    pass
+                return thumbnail
+
+        reader = QImageReader(fullpath)
+        size = reader.size()
+        if size.isValid():
+            reader.setScaledSize(size.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE,
+                Qt.KeepAspectRatio))
+        thumbnail = reader.read()
+        if thumbnail.isNull():
+            return None
+        if thumbnail.width() > THUMBNAIL_SIZE \
+                or thumbnail.height() > THUMBNAIL_SIZE:
+            thumbnail = thumbnail.scaled(QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+                Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+        if stored is not None:
+            for stale in glob.glob(stored.rsplit("-", 1)[0] + "-*.png"):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            thumbnail.save(stored, "PNG")
+            with self.lock:
+                self.saved += 1
+                due = self.saved % TRIM_EVERY == 0
+            if due:
+                self.trim()
+        return thumbnail
+
+    def trim(self):
+        """Delete the least recently used thumbnails beyond max_disk bytes."""
+        entries = []
+        with os.scandir(self.directory) as found:
+            for entry in found:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, stored in sorted(entries):
+            if total <= self.max_disk:
+                break
+            try:
+                os.remove(stored)
+            except OSError:
+                pass
+            total -= size
+
+    def close(self):
+        """Drop the requests not started yet."""
+        with self.lock:
+            self.pending.clear()
+        self.executor.shutdown(wait=False, cancel=True)
+
+
+def stamp(fullpath):
+    """Return the size and mtime of fullpath, or None if it is gone."""
+    try:
+        st = os.stat(fullpath)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def digest(text):
+    return hashlib.blake2b(text.encode("utf-8", "surrogateescape"),
+        digest_size=16).hexdigest()
@@ -1,39 +1,214 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
+import json
 import errno
-from subprocess import call, PIPE
+import shutil
+import tempfile
+from os import path
+from functools import lru_cache
+from collections import namedtuple
+from subprocess import run, PIPE, STDOUT, DEVNULL, TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ResultCache, default_cache_path
+
+
+VERSION = "1.0.6"
+
+DEPENDENCIES = {
+    "jpegoptim": "--version",
+    "optipng": "-v",
+    "advpng": "--version",
+    "pngcrush": "-version"
+}
+
+# apps of the backends that are only used when installed
+OPTIONAL_DEPENDENCIES = {
+    "cwebp": "-version",
+    "gifsicle": "--version",
+    "svgo": "--version",
+}
+
+# how to make each app list the options it supports
+HELP = {
+    "jpegoptim": "--help",
+    "optipng": "-h",
+    "advpng": "--help",
+    "pngcrush": "-help",
+    "cwebp": "-longhelp",
+    "gifsicle": "--help",
+    "svgo": "--help",
+}
+
+# optimization levels as listed in the help, e.g. "-o <level> ... (0-7)" or
+# "-4, --shrink-insane"
+LEVEL_RANGE = re.compile(r"level\D*\((\d)-(\d)\)")
+LEVEL_FLAG = re.compile(r"^\s*-(\d), --shrink-", re.MULTILINE)
+LONG_OPTION = re.compile(r"(?<![\w-])(--?[a-z][\w-]+)")
+
+PROBE_TIMEOUT = 10
+
+# what probing an installed app found out; capabilities has "levels", the
+# optimization levels it supports (or None), and "options", those it lists
+Tool = namedtuple("Tool", "path version capabilities")
 
 
 def check_dependencies():
     """Check if the required command line apps exist."""
     status = True
-    dependencies = {
-        "jpegoptim": "--version",
-        "optipng": "-v",
-        "advpng": "--version",
-        "pngcrush": "-version"
-    }
-
-    for elt in dependencies:
-        retcode = safe_call(elt + " " + dependencies[elt])
-        if retcode != 0:
+    versions = dependency_versions()
+    for elt in DEPENDENCIES:
+        if versions[elt] is None:
             status = False
             print("[error] please install {}".format(elt), file=sys.stderr)
 
     return status
 
 
-def safe_call(command):
-    """Cross-platform command-line check."""
+def dependency_versions():
+    """
+    Return the version line of each required and optional app, or None if
+    it is missing.
+    """
+    return {elt: tool.version if tool else None
+        for elt, tool in find_tools().items()}
+
+
+def open_cache():
+    """Open the result cache for the installed versions of the tools."""
+    versions = dependency_versions()
+    tools = "\n".join(elt + ": " + str(versions[elt])
+        for elt in sorted(versions))
+    return ResultCache(tools=tools)
+
+
+def tool_capabilities(elt):
+    """Return the capabilities of an installed app, or None."""
+    tool = find_tools().get(elt)
+    return tool.capabilities if tool else None
+
+
+def supported_level(elt, level):
+    """Return the highest optimization level of elt up to level."""
+    capabilities = tool_capabilities(elt)
+    levels = capabilities and capabilities["levels"]
+    if not levels:
+        return level
+    return max([known for known in levels if known <= level]
+        or [min(levels)])
+
+
+@lru_cache(maxsize=None)
+def find_tools(filename=None):
+    """
+    Return the Tool of each required and optional app, or None if it is not
+    on the PATH.
+
+    Apps are looked up without a shell and only probed when they are not in
+    the cache yet or their binary changed since, all at once, so a warm
+    start costs a few stat calls.
+    """
+    filename = filename or default_cache_path("tools.json")
+    try:
+        with open(filename) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+
+    tools = {}
+    stale = {}
+    for elt in list(DEPENDENCIES) + list(OPTIONAL_DEPENDENCIES):
+        binary = shutil.which(elt)
+        if binary is None:
+            tools[elt] = None
+            continue
+        try:
+            st = os.stat(binary)
+        except OSError:
+            tools[elt] = None
+            continue
+        key = [binary, st.st_size, st.st_mtime_ns]
+        entry = cached.get(elt)
+        if entry and entry["key"] == key:
+            tools[elt] = Tool(binary, entry["version"], entry["capabilities"])
+        else:
+            stale[elt] = key
+    if not stale:
+        return tools
+
+    with ThreadPoolExecutor(max_workers=len(stale)) as pool:
+        probes = {elt: pool.submit(probe, elt, key[0])
+            for elt, key in stale.items()}
+        for elt, future in probes.items():
+            tools[elt] = future.result()
+    cached = {elt: {"key": stale.get(elt, cached.get(elt, {}).get("key")),
+        "version": tool.version, "capabilities": tool.capabilities}
+        for elt, tool in tools.items() if tool is not None}
+    save_json(filename, cached)
+    return tools
+
+
+def probe(elt, binary):
+    """Run binary to find its version and capabilities; None if it fails."""
+    flag = DEPENDENCIES.get(elt) or OPTIONAL_DEPENDENCIES[elt]
+    retcode, output = safe_output([binary, flag], PROBE_TIMEOUT)
+    if retcode != 0:
+        return None
+    lines = [line.strip() for line in output.splitlines()]
+    version = next((line for line in lines if line), "")
+    # some apps exit with an error after printing their help
+    retcode, output = safe_output([binary, HELP[elt]], PROBE_TIMEOUT)
+    return Tool(binary, version, parse_help(output))
+
+
+def parse_help(output):
+    """Return the capabilities listed in the help output of an app."""
+    levels = None
+    match = LEVEL_RANGE.search(output)
+    if match:
+        levels = list(range(int(match.group(1)), int(match.group(2)) + 1))
+    else:
+        flags = sorted(int(level) for level in LEVEL_FLAG.findall(output))
+        levels = flags or None
+    return {
+        "levels": levels,
+        "options": sorted(set(LONG_OPTION.findall(output))),
+    }
+
+
+def save_json(filename, data):
+    """Write data to filename atomically, ignoring failures."""
+    try:
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        fd, temp = tempfile.mkstemp(prefix=".tools-",
+            dir=path.dirname(filename))
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temp, filename)
+    except OSError:
+        pass
+
+
+def safe_output(argv, timeout=None):
+    """
+    Run argv, without a shell, and return its exit code and combined
+    output; the exit code is None if it could not run or timed out.
+    """
     while True:
         try:
-            return call(command, shell=True, stdout=PIPE)
+            result = run(argv, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT,
+                timeout=timeout)
+            return (result.returncode,
+                result.stdout.decode("utf-8", "replace"))
+        except TimeoutExpired:
+            return None, ""
         except OSError as e:
             if e.errno == errno.EINTR:
                 continue
-            else:
-                raise
+            return None, ""
 
 
 def human_readable_size(num, suffix="B"):
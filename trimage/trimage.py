@@ -1,24 +1,25 @@
 #!/usr/bin/env python3
 
-import time
 import sys
-from os import listdir, path, remove, access, W_OK
-from shutil import copy
-
-from optparse import OptionParser
-from multiprocessing import cpu_count
-from queue import Queue
+from os import path
+from queue import Full, Queue
+from itertools import chain
+from threading import Event
 
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-from ThreadPool import ThreadPool
 from ui import Ui_trimage
 from tools import *
-
-
-VERSION = "1.0.6"
+from executor import BoundedExecutor
+from scheduler import Scheduler, largest_first
+from batch import compress_image, scan
+from image import Image, Status, Convergence
+from backends import FILETYPES, register, jpeg_backend, keep_policy
+from cache import default_cache_path
+from thumbnails import Thumbnails
+import cli
 
 
 class StartQt(QMainWindow):
@@ -41,6 +42,24 @@ class StartQt(QMainWindow):
         # check if dependencies are installed
         if not check_dependencies():
             quit()
+        self.cache = open_cache()
+
+        # recompressing goes on until an image stops getting smaller, and
+        # images that got there are left out of the next recompression; the
+        # first compression is a single pass unless converge is set
+        self.converge = Convergence(
+            self.settings.value("max_passes", 5, type=int),
+            self.settings.value("converge_threshold", 0.001, type=float))
+        self.always_converge = self.settings.value("converge", False,
+            type=bool)
+        # backends that may change how an image looks are opt-in
+        self.lossy = self.settings.value("lossy", False, type=bool)
+
+        # icons of the rows in view, made in the background
+        if self.settings.value("thumbnail_cache", True, type=bool):
+            self.thumbnails = Thumbnails(default_cache_path("thumbnails"))
+        else:
+            self.thumbnails = Thumbnails()
 
         # add quit shortcut
         if hasattr(QKeySequence, "Quit"):
@@ -53,7 +72,18 @@ class StartQt(QMainWindow):
         self.ui.recompress.setEnabled(False)
 
         # make a worker thread
-        self.thread = Worker()
+        self.thread = Worker(self.new_image)
+
+        self.compressing_icon = QIcon(QPixmap(self.ui.get_image("pixmaps/compressing.gif")))
+
+        # one model for the whole session, updated in place
+        self.setup_table()
+
+        # coalesce row updates so finished images don't repaint one by one
+        self.update_timer = QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(100)
+        self.update_timer.timeout.connect(self.update_table)
 
         # connect signals with slots
         self.ui.addfiles.clicked.connect(self.file_dialog)
@@ -61,9 +91,9 @@ class StartQt(QMainWindow):
         self.quit_shortcut.activated.connect(self.close)
         self.ui.processedfiles.drop_event_signal.connect(self.file_drop)
         self.thread.finished.connect(self.update_table)
-        self.thread.update_ui_signal.connect(self.update_table)
-
-        self.compressing_icon = QIcon(QPixmap(self.ui.get_image("pixmaps/compressing.gif")))
+        self.thread.update_ui_signal.connect(self.image_updated)
+        self.thread.found_signal.connect(self.images_found)
+        self.thumbnails.ready.connect(self.row_updated)
 
         # activate command line options
         self.commandline_options()
@@ -73,57 +103,22 @@ class StartQt(QMainWindow):
 
     def commandline_options(self):
         """Set up the command line options."""
+        # -f and -d are handled by cli.main before the GUI is started
         self.cli = False
-        parser = OptionParser(version="%prog " + VERSION,
-            description="GUI front-end to compress png and jpg images via "
-                "advpng, jpegoptim, optipng and pngcrush")
-
-        parser.set_defaults(verbose=True)
-        parser.add_option("-v", "--verbose", action="store_true",
-            dest="verbose", help="Verbose mode (default)")
-        parser.add_option("-q", "--quiet", action="store_false",
-            dest="verbose", help="Quiet mode")
-
-        parser.add_option("-f", "--file", action="store", type="string",
-            dest="filename", help="compresses image and exit")
-        parser.add_option("-d", "--directory", action="store", type="string",
-            dest="directory", help="compresses images in directory and exit")
-
-        options, args = parser.parse_args()
-
-        # make sure we quit after processing finished if using cli
-        if options.filename or options.directory:
-            self.thread.finished.connect(quit)
-            self.cli = True
-
-        # send to correct function
-        if options.filename:
-            self.file_from_cmd(options.filename)
-        if options.directory:
-            self.dir_from_cmd(options.directory)
-
+        options, args = cli.build_parser().parse_args()
         self.verbose = options.verbose
+        # JPEG metadata to keep, the command line taking precedence
+        keep = options.keep_metadata or self.settings.value("keep_metadata",
+            "", type=str)
+        try:
+            register(jpeg_backend(keep_policy(keep)))
+        except ValueError as e:
+            print("[error] {}".format(e), file=sys.stderr)
 
     """
     Input functions
     """
 
-    def dir_from_cmd(self, directory):
-        """
-        Read the files in the directory and send all files to compress_file.
-        """
-        self.showapp = False
-        dirpath = path.abspath(directory)
-        imagedir = listdir(directory)
-        filelist = [path.join(dirpath, image) for image in imagedir]
-        self.delegator(filelist)
-
-    def file_from_cmd(self, image):
-        """Get the file and send it to compress_file"""
-        self.showapp = False
-        filelist = [path.abspath(image)]
-        self.delegator(filelist)
-
     def file_drop(self, images):
         """
         Get a file from the drag and drop handler and send it to compress_file.
@@ -142,7 +137,9 @@ class StartQt(QMainWindow):
             "Select one or more image files to compress",
             directory,
             # this is a fix for file dialog differentiating between cases
-            "Image files (*.png *.jpg *.jpeg *.PNG *.JPG *.JPEG)")
+            "Image files ({})".format(" ".join("*." + extension
+                for extension in sorted(FILETYPES) + sorted(extension.upper()
+                    for extension in FILETYPES))))
 
         self.settings.setValue("fdstate", QVariant(fd.saveState()))
         if images:
@@ -150,8 +147,11 @@ class StartQt(QMainWindow):
             self.delegator([fullpath for fullpath in images])
 
     def recompress_files(self):
-        """Send each file in the current file list to compress_file again."""
-        self.delegator([row.image.fullpath for row in self.imagelist])
+        """
+        Send each file in the current file list to compress_file again,
+        except the ones that converged.
+        """
+        self.delegator([image.fullpath for image in self.imagelist])
 
     """
     Compress functions
@@ -159,84 +159,94 @@ class StartQt(QMainWindow):
 
     def delegator(self, images):
         """
-        Receive all images, check them and send them to the worker thread.
+        Send the images to the worker thread, which scans the directories
+        among them, so the GUI thread never waits for a big tree.
         """
-        delegatorlist = []
+        paths = []
+        recompress = []
         for fullpath in images:
-            try: # recompress images already in the list
-                image = next(i.image for i in self.imagelist
-                    if i.image.fullpath == fullpath)
-                if image.compressed:
-                    image.reset()
-                    image.recompression = True
-                    delegatorlist.append(image)
-            except StopIteration:
-                if not path.isdir(fullpath):
-                    self.add_image(fullpath, delegatorlist)
-                else:
-                    self.walk(fullpath, delegatorlist)
+            image = self.model.find(fullpath)
+            if image is None:
+                paths.append(fullpath)
+            elif image.compressed and not image.converged:
+                # recompress images already in the list
+                image.reset()
+                image.recompression = True
+                image.converge = self.converge
+                recompress.append(image)
+                self.model.mark(image.fullpath)
 
         self.update_table()
-        self.thread.compress_file(delegatorlist, self.showapp, self.verbose,
-            self.imagelist)
-
-    def walk(self, dir, delegatorlist):
-        """
-        Walks a directory, and executes a callback on each file.
-        """
-        dir = path.abspath(dir)
-        for file in [file for file in listdir(dir) if not file in [".","..",".svn",".git",".hg",".bzr",".cvs"]]:
-            nfile = path.join(dir, file)
-
-            if path.isdir(nfile):
-                self.walk(nfile, delegatorlist)
-            else:
-                self.add_image(nfile, delegatorlist)
-
-    def add_image(self, fullpath, delegatorlist):
-        """
-        Adds an image file to the delegator list and update the tray and the title of the window.
-        """
-        image = Image(fullpath)
-        if image.valid:
-            delegatorlist.append(image)
-            self.imagelist.append(ImageRow(image, self.compressing_icon))
-            if QSystemTrayIcon.isSystemTrayAvailable() and not self.cli:
-                self.systemtray.trayIcon.setToolTip("Trimage image compressor (" + str(len(self.imagelist)) + " files)")
-                self.setWindowTitle("Trimage image compressor (" + str(len(self.imagelist)) + " files)")
-        else:
-            print("[error] {} not a supported image file and/or not writable".format(image.fullpath), file=sys.stderr)
+        self.thread.compress_file(paths, recompress)
+
+    def new_image(self, fullpath):
+        """Return the Image of a file found by the worker thread."""
+        return Image(fullpath, self.cache,
+            converge=self.converge if self.always_converge else None,
+            lossy=self.lossy)
+
+    def images_found(self, images):
+        """Add the images the worker thread found to the table."""
+        self.model.add_rows(images)
+        self.update_title()
+        self.update_table()
 
     """
     UI Functions
     """
 
-    def update_table(self):
-        """Update the table view with the latest file data."""
+    def setup_table(self):
+        """Set up the table view and its model once."""
         tview = self.ui.processedfiles
-        # set table model
-        tmodel = TriTableModel(self, self.imagelist,
-            ["Filename", "Old Size", "New Size", "Compressed"])
-        tview.setModel(tmodel)
+        self.model = TriTableModel(self, self.imagelist,
+            ["Filename", "Old Size", "New Size", "Compressed"],
+            self.thumbnails, self.compressing_icon)
+        tview.setModel(self.model)
 
-        # set minimum size of table
+        # all rows have the same height, so the view never measures them
         vh = tview.verticalHeader()
         vh.setVisible(False)
+        vh.setSectionResizeMode(QHeaderView.Fixed)
+        vh.setDefaultSectionSize(25)
 
         # set horizontal header properties
         hh = tview.horizontalHeader()
         hh.setStretchLastSection(True)
 
-        # set all row heights
-        nrows = len(self.imagelist)
-        for row in range(nrows):
-            tview.setRowHeight(row, 25)
-
         # set the second column to be longest
         tview.setColumnWidth(0, 300)
 
-        # enable recompress button
-        self.enable_recompress()
+    def update_title(self):
+        """Show the number of files in the title and the tray."""
+        title = "Trimage image compressor ({} files)".format(
+            len(self.imagelist))
+        if QSystemTrayIcon.isSystemTrayAvailable() and not self.cli:
+            self.systemtray.trayIcon.setToolTip(title)
+            self.setWindowTitle(title)
+
+    def image_updated(self, image):
+        """Mark the row of image as changed and schedule a table update."""
+        self.row_updated(image.fullpath)
+
+    def row_updated(self, fullpath):
+        """Mark the row of fullpath as changed and schedule a table update."""
+        self.model.mark(fullpath)
+        if not self.update_timer.isActive():
+            self.update_timer.start()
+
+    def update_table(self):
+        """Repaint the rows that changed and the ones in view."""
+        tview = self.ui.processedfiles
+        if self.imagelist:
+            # rows in view may have started compressing in the meantime
+            first = max(tview.rowAt(0), 0)
+            last = tview.rowAt(tview.viewport().height())
+            if last < 0:
+                last = len(self.imagelist) - 1
+            self.model.refresh(first, last)
+
+            # enable recompress button
+            self.enable_recompress()
 
     def enable_recompress(self):
         """Enable the recompress button."""
@@ -256,42 +266,121 @@ class StartQt(QMainWindow):
 
     def closeEvent(self, event):
       self.settings.setValue("geometry", QVariant(self.saveGeometry()))
+      self.thread.stop()
+      self.thumbnails.close()
+      self.cache.close()
       event.accept()
 
 
+# the filename column of an image that is not done yet
+STATUS_FORMATS = {
+    Status.QUEUED: "Queued {0}...",
+    Status.COMPRESSING: "Compressing {0}...",
+    Status.FAILED: "ERROR: {0}",
+}
+
+
 class TriTableModel(QAbstractTableModel):
-    def __init__(self, parent, imagelist, header, *args):
+    def __init__(self, parent, imagelist, header, thumbnails, waiting_icon,
+            *args):
         """
         @param parent Qt parent object.
-        @param imagelist A list of tuples.
+        @param imagelist A list of Images, shared with the parent.
         @param header A list of strings.
+        @param thumbnails The Thumbnails that make the icons of the images.
+        @param waiting_icon Shown instead until an image is compressed.
         """
         QAbstractTableModel.__init__(self, parent, *args)
         self.imagelist = imagelist
         self.header = header
+        self.thumbnails = thumbnails
+        self.waiting_icon = waiting_icon
+        # path of every image to its row, so lookups don't scan the list
+        self.paths = {}
+        self.dirty = set()
 
     def rowCount(self, parent):
         """Count the number of rows."""
+        if parent.isValid():
+            return 0
         return len(self.imagelist)
 
     def columnCount(self, parent):
         """Count the number of columns."""
         return len(self.header)
 
+    def add_rows(self, images):
+        """Append images, telling the view about all of them at once."""
+        images = list(images)
+        if not images:
+            return
+        first = len(self.imagelist)
+        self.beginInsertRows(QModelIndex(), first, first + len(images) - 1)
+        for image in images:
+            self.paths[image.fullpath] = len(self.imagelist)
+            self.imagelist.append(image)
+        self.endInsertRows()
+
+    def find(self, fullpath):
+        """Return the Image of fullpath, or None."""
+        row = self.paths.get(fullpath)
+        return None if row is None else self.imagelist[row]
+
+    def mark(self, fullpath):
+        """Remember that the row of fullpath changed."""
+        row = self.paths.get(fullpath)
+        if row is not None:
+            self.dirty.add(row)
+
+    def refresh(self, first, last):
+        """
+        Emit a single dataChanged for the changed rows and first..last.
+
+        The view only repaints the part of that range it shows, so this stays
+        cheap no matter how many rows there are.
+        """
+        rows = self.dirty
+        self.dirty = set()
+        rows.update((first, last))
+        self.dataChanged.emit(self.index(min(rows), 0),
+            self.index(max(rows), len(self.header) - 1))
+
     def data(self, index, role):
         """Fill the table with data."""
         if not index.isValid():
             return QVariant()
-        elif role == Qt.DisplayRole:
-            data = self.imagelist[index.row()][index.column()]
-            return QVariant(data)
+        image = self.imagelist[index.row()]
+        if role == Qt.DisplayRole:
+            return QVariant(self.display(image, index.column()))
         elif index.column() == 0 and role == Qt.DecorationRole:
-            # decorate column 0 with an icon of the image itself
-            f_icon = self.imagelist[index.row()][4]
-            return QVariant(f_icon)
+            # decorate column 0 with an icon of the image itself, once its
+            # thumbnail has been made in the background
+            if not image.compressed:
+                return QVariant(self.waiting_icon)
+            icon = self.thumbnails.icon(image.fullpath)
+            return QVariant() if icon is None else QVariant(icon)
         else:
             return QVariant()
 
+    def display(self, image, column):
+        """Format the text of one cell; only the cells shown are asked for."""
+        if column == 0:
+            if image.status == Status.QUEUED and image.recompression:
+                return "Queued for recompression {0}...".format(
+                    image.filename_w_ext)
+            if image.converged:
+                return "{0} (fully optimized)".format(image.filename_w_ext)
+            return STATUS_FORMATS.get(image.status, "{0}").format(
+                image.filename_w_ext)
+        if not image.compressed:
+            return ""
+        if column == 1:
+            return human_readable_size(image.oldfilesize)
+        if column == 2:
+            return human_readable_size(image.newfilesize)
+        return "%.1f%%" % (100 - (float(image.newfilesize)
+            / image.oldfilesize * 100))
+
     def headerData(self, col, orientation, role):
         """Fill the table headers."""
         if orientation == Qt.Horizontal and (role == Qt.DisplayRole or
@@ -300,145 +389,106 @@ class TriTableModel(QAbstractTableModel):
         return QVariant()
 
 
-class ImageRow:
-    def __init__(self, image, waitingIcon=None):
-        """Build the information visible in the table image row."""
-        self.image = image
-
-        d = {
-            'filename_w_ext': lambda i: self.statusStr().format(i.filename_w_ext),
-            'oldfilesizestr': lambda i: human_readable_size(i.oldfilesize)
-                if i.compressed else "",
-            'newfilesizestr': lambda i: human_readable_size(i.newfilesize)
-                if i.compressed else "",
-            'ratiostr': lambda i:
-                "%.1f%%" % (100 - (float(i.newfilesize) / i.oldfilesize * 100))
-                if i.compressed else "",
-            'icon': lambda i: i.icon if i.compressed else waitingIcon,
-            'fullpath': lambda i: i.fullpath, #only used by cli
-        }
-        names = ['filename_w_ext', 'oldfilesizestr', 'newfilesizestr',
-                      'ratiostr', 'icon']
-        for i, n in enumerate(names):
-            d[i] = d[n]
-
-        self.d = d
-
-    def statusStr(self):
-        """Set the status message."""
-        if self.image.failed:
-            return "ERROR: {0}"
-        if self.image.compressing:
-            message = "Compressing {0}..."
-            return message
-        if not self.image.compressed and self.image.recompression:
-            return "Queued for recompression {0}..."
-        if not self.image.compressed:
-            return "Queued {0}..."
-        return "{0}"
-
-    def __getitem__(self, key):
-        return self.d[key](self.image)
-
-
-class Image:
-    def __init__(self, fullpath):
-        """Gather image information."""
-        self.valid = False
-        self.reset()
-        self.fullpath = fullpath
-        self.filename_w_ext = path.basename(self.fullpath)
-        self.filename, self.filetype = path.splitext(self.filename_w_ext)
-        if path.isfile(self.fullpath) and access(self.fullpath, W_OK):
-            self.filetype = self.filetype[1:].lower()
-            if self.filetype == "jpg":
-                self.filetype = "jpeg"
-            if self.filetype in ["jpeg", "png"]:
-                oldfile = QFileInfo(self.fullpath)
-                self.oldfilesize = oldfile.size()
-                self.icon = QIcon(self.fullpath)
-                self.valid = True
-
-    def reset(self):
-        self.failed = False
-        self.compressed = False
-        self.compressing = False
-        self.recompression = False
-
-    def compress(self):
-        """Compress the image and return it to the thread."""
-        if not self.valid:
-            raise "Tried to compress invalid image (unsupported format or not \
-            file)"
-        self.reset()
-        self.compressing = True
-        runString = {
-            "jpeg": "jpegoptim -f --strip-all '%(file)s'",
-            "png": "optipng -force -o7 '%(file)s'&&advpng -z4 '%(file)s' && pngcrush -rem gAMA -rem alla -rem cHRM -rem iCCP -rem sRGB -rem time '%(file)s' '%(file)s.bak' && mv '%(file)s.bak' '%(file)s'"
-        }
-        # create a backup file
-        backupfullpath = '/tmp/' + self.filename_w_ext
-        copy(self.fullpath, backupfullpath)
-        try:
-            retcode = call(runString[self.filetype] % {"file": self.fullpath},
-                shell=True, stdout=PIPE)
-        except:
-            retcode = -1
-        if retcode == 0:
-            self.newfilesize = QFile(self.fullpath).size()
-            self.compressed = True
-
-            # checks the new file and copy the backup
-            if self.newfilesize >= self.oldfilesize:
-                copy(backupfullpath, self.fullpath)
-                self.newfilesize = self.oldfilesize
-
-            # removes the backup file
-            remove(backupfullpath)
-        else:
-            self.failed = True
-        self.compressing = False
-        self.retcode = retcode
-        return self
+# how many images found by a scan are added to the table at once
+FOUND_BATCH = 256
+# how often, in seconds, a worker waiting for a free slot checks for stop
+SUBMIT_POLL = 0.1
 
 
 class Worker(QThread):
-    update_ui_signal = pyqtSignal()
+    update_ui_signal = pyqtSignal(object)
+    # a list of new images to add to the table
+    found_signal = pyqtSignal(object)
 
-    def __init__(self, parent=None):
+    def __init__(self, new_image, parent=None):
+        """
+        @param new_image A function returning the Image of a path.
+        """
         QThread.__init__(self, parent)
-        self.toDisplay = Queue()
-        self.threadpool = ThreadPool(max_workers=cpu_count())
-
-    def compress_file(self, images, showapp, verbose, imagelist):
-        """Start the worker thread."""
-        for image in images:
-            #FIXME:http://code.google.com/p/pythonthreadpool/issues/detail?id=5
-            time.sleep(0.05)
-            self.threadpool.add_job(image.compress, None,
-                                    return_callback=self.toDisplay.put)
-        self.showapp = showapp
-        self.verbose = verbose
-        self.imagelist = imagelist
+        self.new_image = new_image
+        self.toCompress = Queue()
+        self.scheduler = Scheduler()
+        self.executor = BoundedExecutor(max_workers=self.scheduler.cpus)
+        # paths of the images found so far, so none is added twice
+        self.known = set()
+        self.found = []
+        self.stopping = Event()
+
+    def compress_file(self, paths, images):
+        """
+        Queue the files and directories in paths and the images to compress
+        again, and start the worker thread.
+        """
+        self.toCompress.put((paths, images))
         self.start()
 
-    def run(self):
-        """Compress the given file, get data from it and call update_table."""
-        tp = self.threadpool
-        while self.showapp or not (tp._ThreadPool__active_worker_count == 0 and
-                                   tp._ThreadPool__jobs.empty()):
-            image = self.toDisplay.get()
+    def find_images(self, paths):
+        """
+        Lazily yield the valid images in paths that were not found before,
+        sending them to the table in batches.
+        """
+        for fullpath in scan(paths, onerror=cli.report_error):
+            if self.stopping.is_set():
+                return
+            if fullpath in self.known:
+                continue
+            image = self.new_image(fullpath)
+            if image.valid:
+                self.known.add(fullpath)
+                self.found.append(image)
+                if len(self.found) >= FOUND_BATCH:
+                    self.flush()
+                yield image
+            else:
+                print("[error] {} not a supported image file and/or not writable".format(image.fullpath), file=sys.stderr)
 
-            self.update_ui_signal.emit()
+    def flush(self):
+        """Send the images found since the last flush to the table."""
+        if self.found:
+            self.found_signal.emit(self.found)
+            self.found = []
 
-            if not self.showapp and self.verbose: # we work via the commandline
-                if image.retcode == 0:
-                    ir = ImageRow(image)
-                    print("File: " + ir['fullpath'] + ", Old Size: "
-                        + ir['oldfilesizestr'] + ", New Size: "
-                        + ir['newfilesizestr'] + ", Ratio: " + ir['ratiostr'])
-                else:
-                    print("[error] {} could not be compressed".format(image.fullpath), file=sys.stderr)
+    def run(self):
+        """
+        Scan the queued paths and hand the images, largest first, to the
+        executor as they are found. Waiting for a free slot there holds the
+        scan back, so a big tree is never read far ahead of the pool, but
+        gives up as soon as the worker is stopped. Each image is signalled
+        when it is done.
+        """
+        while True:
+            job = self.toCompress.get()
+            if job is None:
+                break
+            paths, images = job
+            for image in largest_first(chain(images,
+                    self.find_images(paths))):
+                if self.stopping.is_set():
+                    break
+                # the table gets its row before the image can be done
+                self.flush()
+                self.submit(image)
+            self.flush()
+
+    def submit(self, image):
+        """Hand image to the executor once a slot is free, unless stopped."""
+        while not self.stopping.is_set():
+            try:
+                self.executor.submit(compress_image, image, self.scheduler,
+                    callback=lambda future, image=image:
+                        self.update_ui_signal.emit(image),
+                    timeout=SUBMIT_POLL)
+                return
+            except Full:
+                pass
+
+    def stop(self):
+        """Drop the images not started yet and stop the worker thread."""
+        self.stopping.set()
+        self.toCompress.put(None)
+        # the thread gives up waiting for a slot within SUBMIT_POLL
+        self.wait()
+        self.executor.shutdown(wait=False, cancel=True)
 
 
 class Systray(QWidget):
@@ -489,6 +539,9 @@ class Systray(QWidget):
 
 
 if __name__ == "__main__":
+    if cli.is_headless(sys.argv[1:]):
+        sys.exit(cli.main(sys.argv[1:]))
+
     app = QApplication(sys.argv)
     myapp = StartQt()
 
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Check that an optimized image still decodes to the same pixels.
+
+Images are decoded with Pillow, which is only needed when verifying, in a
+pool of processes so the decoding runs beside the optimizers instead of
+holding the GIL. Three modes trade certainty for time:
+
+full     decode both images and compare every pixel
+sampled  compare a share of the tiles of every frame, picked at random
+hash     hash the decoded pixels of each image in turn, so only one frame
+         is in memory at a time
+"""
+
+import math
+import random
+import hashlib
+import importlib.util
+import multiprocessing
+from time import monotonic, process_time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pipeline import Step
+
+
+MODES = ["full", "sampled", "hash"]
+
+TILE = 64
+
+# filetypes Pillow decodes, with the feature it needs for them, if any
+DECODABLE = {
+    "png": None,
+    "jpeg": None,
+    "gif": None,
+    "webp": "webp",
+}
+
+# modes holding more than 8 bits per sample
+WIDE_MODES = {"I", "I;16", "I;16B", "I;16L", "I;16N"}
+
+
+class VerifyError(Exception):
+    """The decoding processes don't work, so nothing can be verified."""
+
+
+def decoder_available():
+    """Return True if Pillow is installed."""
+    return importlib.util.find_spec("PIL") is not None
+
+
+def frames(fullpath, wide):
+    """
+    Yield the frames of an image, normalized so two encodings of the same
+    pixels give the same bytes.
+    """
+    from PIL import Image, ImageSequence
+    with Image.open(fullpath) as image:
+        for frame in ImageSequence.Iterator(image):
+            if not wide:
+                yield frame.convert("RGBA")
+            elif frame.mode in WIDE_MODES:
+                yield frame.convert("I")
+            else:
+                # scale 8 to 16 bits the way a lossless reduction did
+                yield frame.convert("L").convert("I").point(
+                    lambda value: value * 257)
+
+
+def is_wide(fullpath):
+    from PIL import Image
+    with Image.open(fullpath) as image:
+        return image.mode in WIDE_MODES
+
+
+def tiles(size, share, seed):
+    """Return the boxes of share of the TILE sized tiles of an image."""
+    width, height = size
+    boxes = [(x, y, min(x + TILE, width), min(y + TILE, height))
+        for y in range(0, height, TILE) for x in range(0, width, TILE)]
+    count = min(len(boxes), max(1, math.ceil(len(boxes) * share)))
+    return random.Random(seed).sample(boxes, count)
+
+
+def digest(fullpath, wide):
+    """Hash the decoded frames of an image."""
+    hashed = hashlib.blake2b(digest_size=32)
+    for frame in frames(fullpath, wide):
+        hashed.update("{}x{};".format(*frame.size).encode("ascii"))
+        hashed.update(frame.tobytes())
+    return hashed.digest()
+
+
+def compare(original, output, mode, share):
+    """
+    Return whether original and output decode to the same pixels, and the
+    CPU time that took.
+    """
+    start = process_time()
+    wide = is_wide(original) or is_wide(output)
+    if mode == "hash":
+        same = digest(original, wide) == digest(output, wide)
+    else:
+        same = True
+        ours = frames(original, wide)
+        theirs = frames(output, wide)
+        for index, (a, b) in enumerate(zip(ours, theirs)):
+            if a.size != b.size:
+                same = False
+            elif mode == "full":
+                same = a.tobytes() == b.tobytes()
+            else:
+                same = all(a.crop(box).tobytes() == b.crop(box).tobytes()
+                    for box in tiles(a.size, share,
+                        "{}:{}".format(original, index)))
+            if not same:
+                break
+        # both must have run out of frames
+        if same and (next(ours, None) is not None
+                or next(theirs, None) is not None):
+            same = False
+    return same, process_time() - start
+
+
+def decodable(filetype):
+    """Return True if the installed Pillow decodes filetype."""
+    if filetype not in DECODABLE:
+        return False
+    if DECODABLE[filetype] is None:
+        return True
+    from PIL import features
+    return features.check(DECODABLE[filetype])
+
+
+class Verifier:
+    """
+    Compare the pixels of an image before and after optimization.
+
+    Called with the original and the optimized file right before one would
+    replace the other, so an optimizer that changed the image leaves the
+    original in place. Every check is recorded as a "verify" Step with the
+    wall and CPU time it took; types Pillow can't decode are not checked.
+    When the decoding processes fail, VerifyError is raised and kept in
+    error, rather than the image being taken for a different one.
+    """
+
+    def __init__(self, mode="full", share=0.1, workers=None):
+        if mode not in MODES:
+            raise ValueError("unknown verification mode {}".format(mode))
+        self.mode = mode
+        self.share = share
+        self.decodable = {}
+        self.error = None
+        # forked workers would inherit the locks of the threads running now
+        self.pool = ProcessPoolExecutor(max_workers=workers,
+            mp_context=multiprocessing.get_context("forkserver"))
+
+    def __call__(self, filetype, original, output, timings=None,
+            strategy=None):
+        """Return False if output does not look exactly like original."""
+        if filetype not in self.decodable:
+            self.decodable[filetype] = decodable(filetype)
+        if not self.decodable[filetype]:
+            return True
+        start = monotonic()
+        try:
+            same, cpu = self.pool.submit(compare, original, output,
+                self.mode, self.share).result()
+        except (BrokenProcessPool, ImportError) as e:
+            # says nothing about the image, only that the pool is unusable
+            self.error = e
+            raise VerifyError("the decoding processes failed: {}".format(
+                e or type(e).__name__))
+        except Exception:
+            # what can't be decoded can't be shown to be the same image
+            same, cpu = False, 0.0
+        if timings is not None:
+            timings.append(Step("verify", 0 if same else 1,
+                monotonic() - start, cpu, strategy))
+        return same
+
+    def close(self):
+        self.pool.shutdown()
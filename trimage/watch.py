@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+"""
+`trimage watch`: compress images as they arrive in a directory.
+
+The directory is watched with inotify where the kernel has it, and by
+polling otherwise. A file is only compressed once it has settled: no more
+events for it and an unchanged size for a while, so uploads in progress are
+left alone. Compressions go to a pool that stays up for the life of the
+daemon.
+"""
+
+import os
+import sys
+import json
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+from os import path
+from queue import Queue, Empty
+from time import monotonic, sleep
+from threading import Event
+from optparse import OptionParser
+
+from backends import register, jpeg_backend, keep_policy
+from batch import (IGNORED_NAMES, matches, compress_image, format_result,
+    result_record, add_common_options)
+from effort import EFFORTS, EffortModel, EffortPolicy
+from executor import BoundedExecutor
+from image import Image
+from scheduler import Scheduler
+from tools import VERSION, check_dependencies, open_cache
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+EVENT = struct.Struct("iIII")
+
+# prefix of the files pipeline.replace writes next to an image
+TEMP_PREFIX = ".trimage-"
+
+
+def walk_dirs(root):
+    """Yield root and every directory below it, each at most once."""
+    visited = set()
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            st = os.stat(directory)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            yield directory
+            with os.scandir(directory) as entries:
+                stack.extend(entry.path for entry in entries
+                    if entry.name not in IGNORED_NAMES and entry.is_dir())
+        except OSError:
+            continue
+
+
+def walk_files(root):
+    """Yield every file below root."""
+    for directory in walk_dirs(root):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield entry.path
+        except OSError:
+            continue
+
+
+class InotifyWatcher:
+    """Report files written or moved into a tree, using inotify."""
+
+    def __init__(self, root):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.libc = libc
+        self.root = root
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.backlog = []
+        self.add_tree(root, report=False)
+
+    def add_tree(self, root, report=True):
+        """Watch root and the directories below it."""
+        for directory in walk_dirs(root):
+            wd = self.libc.inotify_add_watch(self.fd,
+                os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if directory == root and root == self.root:
+                    raise OSError(error, os.strerror(error), directory)
+                continue
+            self.dirs[wd] = directory
+        if report:
+            # files may have landed before the watch was in place
+            self.backlog.extend(walk_files(root))
+
+    def events(self, timeout):
+        """Return the files written within timeout seconds."""
+        found, self.backlog = self.backlog, []
+        if found:
+            timeout = 0
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return found
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length]
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, so look at everything once
+                found.extend(walk_files(self.root))
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            fullpath = path.join(directory,
+                os.fsdecode(name.rstrip(b"\0")))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(fullpath)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                found.append(fullpath)
+        return found
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Report files that are new or changed, by rescanning every interval."""
+
+    def __init__(self, root, interval=2.0):
+        self.root = root
+        self.interval = interval
+        self.seen = self.snapshot()
+        self.next = monotonic() + interval
+
+    def snapshot(self):
+        seen = {}
+        for fullpath in walk_files(self.root):
+            try:
+                st = os.stat(fullpath)
+            except OSError:
+                continue
+            seen[fullpath] = (st.st_size, st.st_mtime_ns)
+        return seen
+
+    def events(self, timeout):
+        """Return the files that changed since the last scan."""
+        wait = self.next - monotonic()
+        if wait > timeout:
+            sleep(timeout)
+            return []
+        sleep(max(0.0, wait))
+        self.next = monotonic() + self.interval
+        seen = self.snapshot()
+        found = [fullpath for fullpath, stat in seen.items()
+            if self.seen.get(fullpath) != stat]
+        self.seen = seen
+        return found
+
+    def close(self):
+        pass
+
+
+class Debouncer:
+    """
+    Hold back files until they have settled.
+
+    A file is ready once settle seconds have passed since it was last
+    reported and its size did not change meanwhile; files the daemon
+    itself just wrote are dropped.
+    """
+
+    def __init__(self, settle):
+        self.settle = settle
+        self.pending = {}
+        self.written = {}
+
+    def touch(self, fullpath):
+        self.pending[fullpath] = (monotonic() + self.settle, size(fullpath))
+
+    def wrote(self, fullpath, stat):
+        """Remember that the daemon itself left fullpath with stat."""
+        self.written[fullpath] = stat
+
+    def timeout(self):
+        """Return how long until the next file may be ready."""
+        if not self.pending:
+            return 1.0
+        deadline = min(deadline for deadline, _ in self.pending.values())
+        return max(0.0, deadline - monotonic())
+
+    def ready(self):
+        """Return the files that settled."""
+        now = monotonic()
+        found = []
+        for fullpath, (deadline, oldsize) in list(self.pending.items()):
+            if deadline > now:
+                continue
+            newsize = size(fullpath)
+            if newsize != oldsize:
+                self.pending[fullpath] = (now + self.settle, newsize)
+                continue
+            del self.pending[fullpath]
+            if newsize is None:
+                continue
+            try:
+                st = os.stat(fullpath)
+            except OSError:
+                continue
+            if self.written.pop(fullpath, None) != (st.st_size,
+                    st.st_mtime_ns):
+                found.append(fullpath)
+        return found
+
+
+def written(image):
+    """
+    Return the (size, mtime) compressing image left it with, or None if the
+    file was not replaced.
+    """
+    if not image.compressed or image.newfilesize >= image.oldfilesize:
+        return None
+    try:
+        st = os.stat(image.fullpath)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def size(fullpath):
+    try:
+        return os.stat(fullpath).st_size
+    except OSError:
+        return None
+
+
+def build_parser():
+    parser = OptionParser(usage="%prog watch [options] DIRECTORY",
+        version="%prog " + VERSION,
+        description="Compress the images written to DIRECTORY, or below it, "
+            "as they arrive.")
+    parser.set_defaults(verbose=True)
+    parser.add_option("-q", "--quiet", action="store_false", dest="verbose",
+        help="only report errors")
+    parser.add_option("--settle", action="store", type="float",
+        dest="settle", default=1.0, metavar="SECONDS", help="wait until a "
+            "file has been left alone for SECONDS (default: %default)")
+    parser.add_option("--poll", action="store", type="float", dest="poll",
+        metavar="SECONDS", help="rescan every SECONDS instead of using "
+            "inotify")
+    parser.add_option("--include", action="append", dest="include",
+        metavar="PATTERN", help="only compress files matching the glob "
+            "PATTERN; may be given more than once")
+    parser.add_option("--exclude", action="append", dest="exclude",
+        metavar="PATTERN", help="ignore files matching the glob PATTERN; "
+            "may be given more than once")
+    add_common_options(parser)
+    parser.add_option("--effort", action="store", type="choice",
+        choices=EFFORTS, dest="effort", default="max", help="how hard to "
+            "try on PNG files: fast, balanced or max (default)")
+    parser.add_option("--format", action="store", type="choice",
+        choices=["text", "jsonl"], dest="format", default="text",
+        help="print results as text (default) or as JSON Lines")
+    return parser
+
+
+def open_watcher(root, poll=None):
+    """Return an inotify watcher, or a polling one if that is not possible."""
+    if poll is None:
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            if e.filename == root:
+                raise
+            print("[info] inotify unavailable ({}), polling instead".format(
+                e.strerror), file=sys.stderr)
+    return PollingWatcher(root, poll or 2.0)
+
+
+def wanted(fullpath, root, options):
+    """Return True if fullpath should be compressed."""
+    name = path.basename(fullpath)
+    if name.startswith(TEMP_PREFIX):
+        return False
+    relpath = path.relpath(fullpath, root)
+    if options.exclude and matches(name, relpath, options.exclude):
+        return False
+    return not options.include or matches(name, relpath, options.include)
+
+
+def main(argv=None):
+    parser = build_parser()
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or not path.isdir(args[0]):
+        parser.error("expected one directory")
+    try:
+        register(jpeg_backend(keep_policy(options.keep_metadata)))
+    except ValueError as e:
+        parser.error(str(e))
+    root = path.abspath(args[0])
+
+    if not check_dependencies():
+        return 1
+    try:
+        watcher = open_watcher(root, options.poll)
+    except OSError as e:
+        print("[error] can't watch {}: {}".format(root, e.strerror),
+            file=sys.stderr)
+        return 1
+
+    cache = None
+    if options.cache:
+        cache = open_cache()
+    model = EffortModel()
+    scheduler = Scheduler()
+    policy = EffortPolicy(model, options.effort, workers=scheduler.cpus)
+    debouncer = Debouncer(options.settle)
+    done = Queue()
+    running = set()
+    stop = Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    executor = BoundedExecutor(scheduler.cpus)
+    try:
+        while not stop.is_set():
+            for fullpath in watcher.events(min(debouncer.timeout(), 1.0)):
+                if wanted(fullpath, root, options):
+                    debouncer.touch(fullpath)
+            while True:
+                try:
+                    image, stat = done.get_nowait()
+                except Empty:
+                    break
+                running.discard(image.fullpath)
+                if stat is not None:
+                    debouncer.wrote(image.fullpath, stat)
+                report(image, options)
+            for fullpath in debouncer.ready():
+                if fullpath in running:
+                    debouncer.touch(fullpath)
+                    continue
+                image = Image(fullpath, cache, effort=policy,
+                    lossy=options.lossy)
+                if not image.valid:
+                    continue
+                running.add(fullpath)
+                executor.submit(compress_image, image, scheduler,
+                    callback=lambda future, image=image:
+                        done.put((image, written(image))))
+    finally:
+        executor.shutdown(wait=True, cancel=True)
+        watcher.close()
+        while not done.empty():
+            image, stat = done.get()
+            # images that never started were cancelled
+            if image.retcode is not None:
+                report(image, options)
+        if cache is not None:
+            cache.close()
+        model.close()
+    return 0
+
+
+def report(image, options):
+    if options.format == "jsonl":
+        print(json.dumps(result_record(image)), flush=True)
+    elif image.retcode != 0:
+        print("[error] {} could not be compressed".format(image.fullpath),
+            file=sys.stderr)
+    elif options.verbose:
+        print(format_result(image), flush=True)